@@ -0,0 +1,25 @@
+-- Per companion rating aggregates, kept up to date by the rating handlers in main.py
+-- Run once on databases created before rating_summary existed
+
+START TRANSACTION;
+
+CREATE TABLE `rating_summary` (
+  `gf_bf_id` varchar(100) NOT NULL,
+  `total_rate` int NOT NULL DEFAULT '0',
+  `total_count` int NOT NULL DEFAULT '0',
+  `rate_1` int NOT NULL DEFAULT '0',
+  `rate_2` int NOT NULL DEFAULT '0',
+  `rate_3` int NOT NULL DEFAULT '0',
+  `rate_4` int NOT NULL DEFAULT '0',
+  `rate_5` int NOT NULL DEFAULT '0',
+  PRIMARY KEY (`gf_bf_id`),
+  CONSTRAINT `summary_to_user` FOREIGN KEY (`gf_bf_id`) REFERENCES `users` (`id`) ON DELETE RESTRICT ON UPDATE RESTRICT
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+-- Backfill from existing ratings
+INSERT INTO `rating_summary` (`gf_bf_id`, `total_rate`, `total_count`, `rate_1`, `rate_2`, `rate_3`, `rate_4`, `rate_5`)
+SELECT `gf_bf_id`, SUM(`rate`), COUNT(*), SUM(`rate` = 1), SUM(`rate` = 2), SUM(`rate` = 3), SUM(`rate` = 4), SUM(`rate` = 5)
+FROM `rating`
+GROUP BY `gf_bf_id`;
+
+COMMIT;
@@ -0,0 +1,11 @@
+-- Indexes behind GET /api/companions/search
+
+ALTER TABLE `users`
+  ADD KEY `users_search` (`gender`,`age`,`height`);
+
+ALTER TABLE `user_package`
+  ADD KEY `package_search` (`user_id`,`available`,`price`);
+
+ALTER TABLE `rating_summary`
+  ADD COLUMN `average_rate` decimal(4,2) GENERATED ALWAYS AS ((`total_rate` / nullif(`total_count`,0))) STORED,
+  ADD KEY `summary_average_rate` (`average_rate`);
@@ -0,0 +1,8 @@
+-- Unique keys used by register (duplicate check) and login (lookup by username)
+-- Fails if the table already holds duplicate usernames or emails, clean those up first:
+--   SELECT username, COUNT(*) FROM users GROUP BY username HAVING COUNT(*) > 1;
+--   SELECT email, COUNT(*) FROM users GROUP BY email HAVING COUNT(*) > 1;
+
+ALTER TABLE `users`
+  ADD UNIQUE KEY `users_username` (`username`),
+  ADD UNIQUE KEY `users_email` (`email`);
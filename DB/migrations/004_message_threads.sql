@@ -0,0 +1,19 @@
+-- Message timestamps for thread pagination and a maintained unread counter per user
+
+START TRANSACTION;
+
+ALTER TABLE `messages`
+  ADD COLUMN `created_at` datetime(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+  ADD KEY `message_thread` (`sender_id`,`recipient_id`,`created_at`);
+
+CREATE TABLE `unread_counter` (
+  `user_id` varchar(100) NOT NULL,
+  `unread_count` int NOT NULL DEFAULT '0',
+  PRIMARY KEY (`user_id`),
+  CONSTRAINT `unread_to_user` FOREIGN KEY (`user_id`) REFERENCES `users` (`id`) ON DELETE RESTRICT ON UPDATE RESTRICT
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+INSERT INTO `unread_counter` (`user_id`, `unread_count`)
+SELECT `recipient_id`, COUNT(*) FROM `messages` WHERE `is_read` = 0 GROUP BY `recipient_id`;
+
+COMMIT;
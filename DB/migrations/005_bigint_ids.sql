@@ -0,0 +1,29 @@
+-- Optional: store ids as BIGINT UNSIGNED instead of varchar(100), then set
+-- ID_STORAGE = 'bigint' in config.py.
+-- Only for databases that hold nothing but Snowflake ids (ids.py). The old
+-- 24 digit timestamp ids, like the seed admin in rentagirlfriend.sql, do not
+-- fit in a BIGINT. Ids are above 2^53, so JavaScript clients must read them
+-- as strings.
+
+SET FOREIGN_KEY_CHECKS = 0;
+
+ALTER TABLE `users` MODIFY `id` bigint UNSIGNED NOT NULL;
+ALTER TABLE `user_package`
+  MODIFY `id` bigint UNSIGNED NOT NULL,
+  MODIFY `user_id` bigint UNSIGNED NOT NULL;
+ALTER TABLE `orders`
+  MODIFY `id` bigint UNSIGNED NOT NULL,
+  MODIFY `package_id` bigint UNSIGNED NOT NULL,
+  MODIFY `user_id` bigint UNSIGNED NOT NULL;
+ALTER TABLE `rating`
+  MODIFY `id` bigint UNSIGNED NOT NULL,
+  MODIFY `gf_bf_id` bigint UNSIGNED NOT NULL,
+  MODIFY `user_id` bigint UNSIGNED NOT NULL;
+ALTER TABLE `rating_summary` MODIFY `gf_bf_id` bigint UNSIGNED NOT NULL;
+ALTER TABLE `messages`
+  MODIFY `id` bigint UNSIGNED NOT NULL,
+  MODIFY `sender_id` bigint UNSIGNED NOT NULL,
+  MODIFY `recipient_id` bigint UNSIGNED NOT NULL;
+ALTER TABLE `unread_counter` MODIFY `user_id` bigint UNSIGNED NOT NULL;
+
+SET FOREIGN_KEY_CHECKS = 1;
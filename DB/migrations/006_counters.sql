@@ -0,0 +1,13 @@
+-- Maintained row counts behind /api/users/total and /api/orders/total
+
+CREATE TABLE `counters` (
+  `name` varchar(50) NOT NULL,
+  `shard` tinyint UNSIGNED NOT NULL,
+  `value` bigint NOT NULL DEFAULT '0',
+  PRIMARY KEY (`name`,`shard`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+INSERT INTO `counters` (`name`, `shard`, `value`)
+SELECT 'users', 0, COUNT(*) FROM `users`
+UNION ALL
+SELECT 'orders', 0, COUNT(*) FROM `orders`;
@@ -0,0 +1,18 @@
+-- Companion calendar: bookable time slots, order_id set once a slot is booked.
+-- Slots are at most SLOT_MAX_HOURS long, so lookups by time only scan
+-- start_at in [T - SLOT_MAX_HOURS, T] on slot_companion / slot_free.
+-- If 005_bigint_ids.sql was applied, create id, companion_id and order_id as
+-- bigint UNSIGNED instead.
+
+CREATE TABLE `availability_slots` (
+  `id` varchar(100) NOT NULL,
+  `companion_id` varchar(100) NOT NULL,
+  `start_at` datetime NOT NULL,
+  `end_at` datetime NOT NULL,
+  `order_id` varchar(100) DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  KEY `slot_companion` (`companion_id`,`start_at`,`end_at`),
+  KEY `slot_free` (`order_id`,`start_at`,`end_at`,`companion_id`),
+  CONSTRAINT `slot_to_order` FOREIGN KEY (`order_id`) REFERENCES `orders` (`id`) ON DELETE RESTRICT ON UPDATE RESTRICT,
+  CONSTRAINT `slot_to_user` FOREIGN KEY (`companion_id`) REFERENCES `users` (`id`) ON DELETE RESTRICT ON UPDATE RESTRICT
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
@@ -0,0 +1,19 @@
+-- Background job queue (order expiry/completion, notifications), see jobs.py.
+-- Workers pick due jobs through job_due with FOR UPDATE SKIP LOCKED
+-- (MySQL 8.0+). dedupe_key keeps one job per key, e.g. one expiry per order.
+
+CREATE TABLE `jobs` (
+  `id` bigint UNSIGNED NOT NULL AUTO_INCREMENT,
+  `kind` varchar(50) NOT NULL,
+  `payload` json NOT NULL,
+  `status` varchar(10) NOT NULL,
+  `run_at` datetime(6) NOT NULL,
+  `attempts` int NOT NULL DEFAULT '0',
+  `max_attempts` int NOT NULL,
+  `dedupe_key` varchar(150) DEFAULT NULL,
+  `last_error` text,
+  `created_at` datetime(6) NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `job_dedupe` (`dedupe_key`),
+  KEY `job_due` (`status`,`run_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
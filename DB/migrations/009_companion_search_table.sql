@@ -0,0 +1,50 @@
+-- One row per user with at least one package, holding everything
+-- GET /api/companions/search filters and sorts on, kept up to date by the app
+-- (refresh_companion_search). Every sort has an index, alone and behind
+-- gender, so a page is read in index order instead of sorting all matches.
+-- If 005_bigint_ids.sql was applied, create user_id as bigint UNSIGNED instead.
+
+-- "newest" sorts on when the user registered, not on the id: varchar and
+-- bigint ids don't order the same way. Existing users get the time of this
+-- migration.
+ALTER TABLE `users`
+  ADD COLUMN `created_at` datetime(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6);
+
+-- The search reads companion_search now, these 002 indexes have no reader left
+ALTER TABLE `users` DROP KEY `users_search`;
+ALTER TABLE `user_package` DROP KEY `package_search`;
+ALTER TABLE `rating_summary` DROP KEY `summary_average_rate`;
+
+CREATE TABLE `companion_search` (
+  `user_id` varchar(100) NOT NULL,
+  `gender` int NOT NULL,
+  `age` int NOT NULL,
+  `height` int NOT NULL,
+  `min_price` int NOT NULL,
+  `available_min_price` int DEFAULT NULL,
+  `average_rate` decimal(4,2) NOT NULL DEFAULT '0.00',
+  `total_count` int NOT NULL DEFAULT '0',
+  `created_at` datetime(6) NOT NULL,
+  PRIMARY KEY (`user_id`),
+  KEY `search_newest` (`created_at`,`user_id`),
+  KEY `search_gender_newest` (`gender`,`created_at`,`user_id`),
+  KEY `search_price` (`min_price`,`user_id`),
+  KEY `search_gender_price` (`gender`,`min_price`,`user_id`),
+  KEY `search_available_price` (`available_min_price`,`user_id`),
+  KEY `search_gender_available_price` (`gender`,`available_min_price`,`user_id`),
+  KEY `search_rating` (`average_rate`,`user_id`),
+  KEY `search_gender_rating` (`gender`,`average_rate`,`user_id`),
+  KEY `search_age` (`age`,`user_id`),
+  KEY `search_gender_age` (`gender`,`age`,`user_id`),
+  KEY `search_height` (`height`,`user_id`),
+  KEY `search_gender_height` (`gender`,`height`,`user_id`),
+  CONSTRAINT `search_to_user` FOREIGN KEY (`user_id`) REFERENCES `users` (`id`) ON DELETE RESTRICT ON UPDATE RESTRICT
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+INSERT INTO `companion_search` (`user_id`, `gender`, `age`, `height`, `min_price`, `available_min_price`, `average_rate`, `total_count`, `created_at`)
+SELECT u.id, u.gender, u.age, u.height, MIN(p.price), MIN(CASE WHEN p.available THEN p.price END),
+       COALESCE(s.average_rate, 0), COALESCE(s.total_count, 0), u.created_at
+FROM `users` u
+JOIN `user_package` p ON p.user_id = u.id
+LEFT JOIN `rating_summary` s ON s.gf_bf_id = u.id
+GROUP BY u.id, u.gender, u.age, u.height, u.created_at, s.average_rate, s.total_count;
@@ -0,0 +1,10 @@
+-- orders.status was TEXT, which can't be indexed, so the open order check of
+-- create_order read a package's whole order history under the package lock.
+-- As varchar it leads the (package_id, status) key, and the check only reads
+-- the package's open orders. order_package_status also serves the
+-- order_to_package foreign key, so the old single column key goes.
+
+ALTER TABLE `orders`
+  MODIFY `status` varchar(20) NOT NULL,
+  ADD KEY `order_package_status` (`package_id`,`status`),
+  DROP KEY `order_to_package`;
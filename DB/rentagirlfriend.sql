@@ -23,6 +23,77 @@ SET time_zone = "+00:00";
 
 -- --------------------------------------------------------
 
+--
+-- Table structure for table `availability_slots`
+--
+
+CREATE TABLE `availability_slots` (
+  `id` varchar(100) NOT NULL,
+  `companion_id` varchar(100) NOT NULL,
+  `start_at` datetime NOT NULL,
+  `end_at` datetime NOT NULL,
+  `order_id` varchar(100) DEFAULT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `companion_search`
+--
+
+CREATE TABLE `companion_search` (
+  `user_id` varchar(100) NOT NULL,
+  `gender` int NOT NULL,
+  `age` int NOT NULL,
+  `height` int NOT NULL,
+  `min_price` int NOT NULL,
+  `available_min_price` int DEFAULT NULL,
+  `average_rate` decimal(4,2) NOT NULL DEFAULT '0.00',
+  `total_count` int NOT NULL DEFAULT '0',
+  `created_at` datetime(6) NOT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `counters`
+--
+
+CREATE TABLE `counters` (
+  `name` varchar(50) NOT NULL,
+  `shard` tinyint UNSIGNED NOT NULL,
+  `value` bigint NOT NULL DEFAULT '0'
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+--
+-- Dumping data for table `counters`
+--
+
+INSERT INTO `counters` (`name`, `shard`, `value`) VALUES
+('orders', 0, 0),
+('users', 0, 1);
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `jobs`
+--
+
+CREATE TABLE `jobs` (
+  `id` bigint UNSIGNED NOT NULL,
+  `kind` varchar(50) NOT NULL,
+  `payload` json NOT NULL,
+  `status` varchar(10) NOT NULL,
+  `run_at` datetime(6) NOT NULL,
+  `attempts` int NOT NULL DEFAULT '0',
+  `max_attempts` int NOT NULL,
+  `dedupe_key` varchar(150) DEFAULT NULL,
+  `last_error` text,
+  `created_at` datetime(6) NOT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+-- --------------------------------------------------------
+
 --
 -- Table structure for table `messages`
 --
@@ -32,7 +103,8 @@ CREATE TABLE `messages` (
   `sender_id` varchar(100) NOT NULL,
   `recipient_id` varchar(100) NOT NULL,
   `message` text NOT NULL,
-  `is_read` tinyint(1) NOT NULL
+  `is_read` tinyint(1) NOT NULL,
+  `created_at` datetime(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 
 -- --------------------------------------------------------
@@ -46,7 +118,7 @@ CREATE TABLE `orders` (
   `package_id` varchar(100) NOT NULL,
   `user_id` varchar(100) NOT NULL,
   `total_price` int NOT NULL,
-  `status` text NOT NULL
+  `status` varchar(20) NOT NULL
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 
 -- --------------------------------------------------------
@@ -65,6 +137,35 @@ CREATE TABLE `rating` (
 
 -- --------------------------------------------------------
 
+--
+-- Table structure for table `rating_summary`
+--
+
+CREATE TABLE `rating_summary` (
+  `gf_bf_id` varchar(100) NOT NULL,
+  `total_rate` int NOT NULL DEFAULT '0',
+  `total_count` int NOT NULL DEFAULT '0',
+  `rate_1` int NOT NULL DEFAULT '0',
+  `rate_2` int NOT NULL DEFAULT '0',
+  `rate_3` int NOT NULL DEFAULT '0',
+  `rate_4` int NOT NULL DEFAULT '0',
+  `rate_5` int NOT NULL DEFAULT '0',
+  `average_rate` decimal(4,2) GENERATED ALWAYS AS ((`total_rate` / nullif(`total_count`,0))) STORED
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `unread_counter`
+--
+
+CREATE TABLE `unread_counter` (
+  `user_id` varchar(100) NOT NULL,
+  `unread_count` int NOT NULL DEFAULT '0'
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+-- --------------------------------------------------------
+
 --
 -- Table structure for table `users`
 --
@@ -79,7 +180,8 @@ CREATE TABLE `users` (
   `profile_picture` varchar(255) DEFAULT NULL,
   `password` varchar(255) NOT NULL,
   `gender` int NOT NULL,
-  `role` int NOT NULL
+  `role` int NOT NULL,
+  `created_at` datetime(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 
 --
@@ -107,20 +209,61 @@ CREATE TABLE `user_package` (
 -- Indexes for dumped tables
 --
 
+--
+-- Indexes for table `availability_slots`
+--
+ALTER TABLE `availability_slots`
+  ADD PRIMARY KEY (`id`),
+  ADD KEY `slot_companion` (`companion_id`,`start_at`,`end_at`),
+  ADD KEY `slot_free` (`order_id`,`start_at`,`end_at`,`companion_id`);
+
+--
+-- Indexes for table `companion_search`
+--
+ALTER TABLE `companion_search`
+  ADD PRIMARY KEY (`user_id`),
+  ADD KEY `search_newest` (`created_at`,`user_id`),
+  ADD KEY `search_gender_newest` (`gender`,`created_at`,`user_id`),
+  ADD KEY `search_price` (`min_price`,`user_id`),
+  ADD KEY `search_gender_price` (`gender`,`min_price`,`user_id`),
+  ADD KEY `search_available_price` (`available_min_price`,`user_id`),
+  ADD KEY `search_gender_available_price` (`gender`,`available_min_price`,`user_id`),
+  ADD KEY `search_rating` (`average_rate`,`user_id`),
+  ADD KEY `search_gender_rating` (`gender`,`average_rate`,`user_id`),
+  ADD KEY `search_age` (`age`,`user_id`),
+  ADD KEY `search_gender_age` (`gender`,`age`,`user_id`),
+  ADD KEY `search_height` (`height`,`user_id`),
+  ADD KEY `search_gender_height` (`gender`,`height`,`user_id`);
+
+--
+-- Indexes for table `counters`
+--
+ALTER TABLE `counters`
+  ADD PRIMARY KEY (`name`,`shard`);
+
+--
+-- Indexes for table `jobs`
+--
+ALTER TABLE `jobs`
+  ADD PRIMARY KEY (`id`),
+  ADD UNIQUE KEY `job_dedupe` (`dedupe_key`),
+  ADD KEY `job_due` (`status`,`run_at`);
+
 --
 -- Indexes for table `messages`
 --
 ALTER TABLE `messages`
   ADD PRIMARY KEY (`id`),
   ADD KEY `sender_to_user` (`sender_id`),
-  ADD KEY `recipient_to_user` (`recipient_id`);
+  ADD KEY `recipient_to_user` (`recipient_id`),
+  ADD KEY `message_thread` (`sender_id`,`recipient_id`,`created_at`);
 
 --
 -- Indexes for table `orders`
 --
 ALTER TABLE `orders`
   ADD PRIMARY KEY (`id`),
-  ADD KEY `order_to_package` (`package_id`),
+  ADD KEY `order_package_status` (`package_id`,`status`),
   ADD KEY `order_to_user` (`user_id`);
 
 --
@@ -131,11 +274,25 @@ ALTER TABLE `rating`
   ADD KEY `user_rating_to_user` (`user_id`),
   ADD KEY `gf_bf_to_user` (`gf_bf_id`);
 
+--
+-- Indexes for table `rating_summary`
+--
+ALTER TABLE `rating_summary`
+  ADD PRIMARY KEY (`gf_bf_id`);
+
+--
+-- Indexes for table `unread_counter`
+--
+ALTER TABLE `unread_counter`
+  ADD PRIMARY KEY (`user_id`);
+
 --
 -- Indexes for table `users`
 --
 ALTER TABLE `users`
-  ADD PRIMARY KEY (`id`);
+  ADD PRIMARY KEY (`id`),
+  ADD UNIQUE KEY `users_username` (`username`),
+  ADD UNIQUE KEY `users_email` (`email`);
 
 --
 -- Indexes for table `user_package`
@@ -144,10 +301,33 @@ ALTER TABLE `user_package`
   ADD PRIMARY KEY (`id`),
   ADD KEY `package_to_user` (`user_id`);
 
+--
+-- AUTO_INCREMENT for dumped tables
+--
+
+--
+-- AUTO_INCREMENT for table `jobs`
+--
+ALTER TABLE `jobs`
+  MODIFY `id` bigint UNSIGNED NOT NULL AUTO_INCREMENT;
+
 --
 -- Constraints for dumped tables
 --
 
+--
+-- Constraints for table `availability_slots`
+--
+ALTER TABLE `availability_slots`
+  ADD CONSTRAINT `slot_to_order` FOREIGN KEY (`order_id`) REFERENCES `orders` (`id`) ON DELETE RESTRICT ON UPDATE RESTRICT,
+  ADD CONSTRAINT `slot_to_user` FOREIGN KEY (`companion_id`) REFERENCES `users` (`id`) ON DELETE RESTRICT ON UPDATE RESTRICT;
+
+--
+-- Constraints for table `companion_search`
+--
+ALTER TABLE `companion_search`
+  ADD CONSTRAINT `search_to_user` FOREIGN KEY (`user_id`) REFERENCES `users` (`id`) ON DELETE RESTRICT ON UPDATE RESTRICT;
+
 --
 -- Constraints for table `messages`
 --
@@ -169,6 +349,18 @@ ALTER TABLE `rating`
   ADD CONSTRAINT `gf_bf_to_user` FOREIGN KEY (`gf_bf_id`) REFERENCES `users` (`id`) ON DELETE RESTRICT ON UPDATE RESTRICT,
   ADD CONSTRAINT `user_rating_to_user` FOREIGN KEY (`user_id`) REFERENCES `users` (`id`) ON DELETE RESTRICT ON UPDATE RESTRICT;
 
+--
+-- Constraints for table `rating_summary`
+--
+ALTER TABLE `rating_summary`
+  ADD CONSTRAINT `summary_to_user` FOREIGN KEY (`gf_bf_id`) REFERENCES `users` (`id`) ON DELETE RESTRICT ON UPDATE RESTRICT;
+
+--
+-- Constraints for table `unread_counter`
+--
+ALTER TABLE `unread_counter`
+  ADD CONSTRAINT `unread_to_user` FOREIGN KEY (`user_id`) REFERENCES `users` (`id`) ON DELETE RESTRICT ON UPDATE RESTRICT;
+
 --
 -- Constraints for table `user_package`
 --
@@ -0,0 +1,7 @@
+# For ASGI servers: uvicorn asgi:app (needs pip3 install asgiref)
+# Each request still runs on a worker thread, gunicorn stays the better fit.
+from asgiref.wsgi import WsgiToAsgi
+
+from wsgi import app as wsgi_app
+
+app = WsgiToAsgi(wsgi_app)
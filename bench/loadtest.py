@@ -0,0 +1,275 @@
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import threading
+import time
+import urllib.parse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# python bench/loadtest.py --url http://localhost:3002 --concurrency 32 --duration 60
+# Runs against an app started on the database from bench/seed.py, e.g.
+#   APP_CONFIG=config.ProductionConfig MYSQL_DB=rentagirlfriend_bench RATE_LIMIT_ENABLED=0 gunicorn -c gunicorn.conf.py wsgi:app
+# Each thread is one virtual user: it logs in once, then keeps picking a
+# scenario from the mix. Latency is recorded per route.
+
+SCENARIOS = ('login', 'browse', 'book', 'chat')
+DEFAULT_MIX = 'login=5,browse=60,book=10,chat=25'
+
+# Answers that are part of normal traffic, anything else counts as an error.
+# 409 (package already booked) is reported on its own, a high count means the
+# route measured its reject path rather than real bookings.
+EXPECTED = {200, 201, 304, 404}
+CONFLICT = 409
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load test the API')
+    parser.add_argument('--url', default='http://localhost:3002')
+    parser.add_argument('--manifest', default=os.path.join(ROOT, 'bench', 'manifest.json'))
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30, help='seconds, after warmup')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds not recorded')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='scenario weights')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', dest='json_path', help='write results to this file')
+    parser.add_argument('--compare', help='results file from an earlier run')
+    return parser.parse_args()
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise SystemExit(f"Unknown scenario {name!r}, pick from {', '.join(SCENARIOS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    # Nearest rank
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+class Client:
+    def __init__(self, url, recorder):
+        parts = urllib.parse.urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.https = parts.scheme == 'https'
+        self.recorder = recorder
+        self.token = None
+        self.conn = None
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        self.conn = cls(self.host, self.port, timeout=30)
+
+    # route is the label results are grouped under, path the actual URL
+    def request(self, method, route, path, body=None):
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        if self.token:
+            headers['Authorization'] = f"Bearer {self.token}"
+        if self.conn is None:
+            self._connect()
+
+        start = time.perf_counter()
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+            payload = response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            # Dropped keep-alive connection or refused, reconnect next time
+            self.conn.close()
+            self.conn = None
+            payload, status = b'', 0
+        self.recorder.record(f"{method} {route}", status, time.perf_counter() - start)
+
+        if status and payload and response.getheader('Content-Type', '').startswith('application/json'):
+            try:
+                return status, json.loads(payload)
+            except ValueError:
+                pass
+        return status, None
+
+
+class Recorder:
+    def __init__(self):
+        self.enabled = False
+        self.latencies = {}
+        self.statuses = {}
+        self._lock = threading.Lock()
+
+    def record(self, route, status, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.latencies.setdefault(route, []).append(seconds)
+            counts = self.statuses.setdefault(route, {})
+            counts[status] = counts.get(status, 0) + 1
+
+
+class VirtualUser:
+    def __init__(self, url, manifest, rng, recorder):
+        self.client = Client(url, recorder)
+        self.manifest = manifest
+        self.rng = rng
+        self.username = rng.choice(manifest['usernames'])
+        self.companion_ids = []
+
+    def login(self):
+        status, data = self.client.request('POST', '/api/login', '/api/login', {
+            'username': self.username,
+            'password': self.manifest['password'],
+        })
+        if status == 200 and data:
+            self.client.token = data['token']
+
+    # Listing page: one search, then the rating summaries of the page
+    def browse(self):
+        params = {'limit': 20, 'sort': self.rng.choice(('newest', 'price', 'rating'))}
+        if self.rng.random() < 0.5:
+            params['gender'] = self.rng.randint(0, 1)
+        if self.rng.random() < 0.3:
+            params['max_price'] = self.rng.randrange(200000, 1000000, 50000)
+        status, data = self.client.request('GET', '/api/companions/search',
+                                           '/api/companions/search?' + urllib.parse.urlencode(params))
+        ids = [row['id'] for row in data] if status == 200 and isinstance(data, list) else []
+        if ids:
+            self.companion_ids = ids
+            self.client.request('POST', '/api/sum-rating/batch', '/api/sum-rating/batch', {'ids': ids})
+            companion = self.rng.choice(ids)
+            self.client.request('GET', '/api/sum-rating/<id>', f"/api/sum-rating/{companion}")
+
+    # Book a package, then cancel so it can be booked again; an order left
+    # pending would hold the package for ORDER_PENDING_TTL
+    def book(self):
+        if not self.manifest['packages']:
+            return
+        status, data = self.client.request('POST', '/api/order', '/api/order', {
+            'package_id': self.rng.choice(self.manifest['packages']),
+            'quantity': self.rng.randint(1, 3),
+        })
+        if status == 200 and data and data.get('id'):
+            self.client.request('PUT', '/api/order/<id>/status', f"/api/order/{data['id']}/status",
+                                {'status': 'cancelled'})
+
+    # Send a message, reload the thread, poll the unread badge
+    def chat(self):
+        other = self.rng.choice(self.companion_ids or self.manifest['user_ids'])
+        self.client.request('POST', '/api/message', '/api/message', {
+            'recipient_id': other,
+            'message': 'bench message',
+        })
+        self.client.request('GET', '/api/message/thread/<id>', f"/api/message/thread/{other}?limit=50")
+        self.client.request('GET', '/api/message/unread', '/api/message/unread')
+
+    def run(self, mix, stop):
+        self.login()
+        names = list(mix)
+        weights = [mix[name] for name in names]
+        while not stop.is_set():
+            getattr(self, self.rng.choices(names, weights)[0])()
+
+
+def summarize(recorder, seconds):
+    results = {}
+    for route, values in sorted(recorder.latencies.items()):
+        values.sort()
+        statuses = recorder.statuses[route]
+        results[route] = {
+            'count': len(values),
+            'errors': sum(count for status, count in statuses.items() if status not in EXPECTED and status != CONFLICT),
+            'conflicts': statuses.get(CONFLICT, 0),
+            'statuses': {str(status): count for status, count in sorted(statuses.items())},
+            'rps': len(values) / seconds,
+            'p50_ms': percentile(values, 50) * 1000,
+            'p95_ms': percentile(values, 95) * 1000,
+            'p99_ms': percentile(values, 99) * 1000,
+            'max_ms': values[-1] * 1000,
+        }
+    return results
+
+
+def print_results(results, seconds, baseline=None):
+    header = f"{'route':<36} {'count':>7} {'err':>5} {'409':>5} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}"
+    if baseline:
+        header += f" {'p95 vs base':>12} {'req/s vs base':>14}"
+    print(header)
+    print('-' * len(header))
+    total = 0
+    for route, item in results.items():
+        total += item['count']
+        line = (f"{route:<36} {item['count']:>7} {item['errors']:>5} {item.get('conflicts', 0):>5} {item['rps']:>8.1f} "
+                f"{item['p50_ms']:>8.1f} {item['p95_ms']:>8.1f} {item['p99_ms']:>8.1f} {item['max_ms']:>8.1f}")
+        base = (baseline or {}).get(route)
+        if base:
+            line += f" {change(item['p95_ms'], base['p95_ms']):>12} {change(item['rps'], base['rps']):>14}"
+        print(line)
+    print('-' * len(header))
+    print(f"{total} requests in {seconds:.1f}s, {total / seconds:.1f} req/s")
+
+
+def change(value, base):
+    if not base:
+        return 'n/a'
+    return f"{(value - base) / base * 100:+.1f}%"
+
+
+def main():
+    args = parse_args()
+    with open(args.manifest, encoding='utf-8') as f:
+        manifest = json.load(f)
+    mix = parse_mix(args.mix)
+    master = random.Random(args.seed)
+
+    recorder = Recorder()
+    stop = threading.Event()
+    users = [VirtualUser(args.url, manifest, random.Random(master.random()), recorder)
+             for _ in range(args.concurrency)]
+    threads = [threading.Thread(target=user.run, args=(mix, stop), daemon=True) for user in users]
+    for thread in threads:
+        thread.start()
+
+    time.sleep(args.warmup)
+    recorder.enabled = True
+    start = time.perf_counter()
+    time.sleep(args.duration)
+    recorder.enabled = False
+    elapsed = time.perf_counter() - start
+    stop.set()
+    for thread in threads:
+        thread.join(timeout=35)
+
+    results = summarize(recorder, elapsed)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)['routes']
+    print(f"{args.concurrency} users, mix {args.mix}")
+    print_results(results, elapsed, baseline)
+
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'url': args.url,
+                'concurrency': args.concurrency,
+                'duration': elapsed,
+                'mix': mix,
+                'routes': results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
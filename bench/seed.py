@@ -0,0 +1,169 @@
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+
+import bcrypt
+import MySQLdb
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from config import Config
+from ids import SnowflakeGenerator, format_id, MAX_WORKER_ID
+
+SCHEMA = os.path.join(ROOT, 'DB', 'rentagirlfriend.sql')
+BATCH = 1000
+
+# python bench/seed.py --db rentagirlfriend_bench --users 10000
+# Recreates the database from DB/rentagirlfriend.sql, fills it with random
+# data and writes a manifest (logins, ids) for bench/loadtest.py
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Seed a benchmark database')
+    parser.add_argument('--host', default=Config.MYSQL_HOST)
+    parser.add_argument('--port', type=int, default=Config.MYSQL_PORT)
+    parser.add_argument('--user', default=Config.MYSQL_USER)
+    parser.add_argument('--password', default=Config.MYSQL_PASSWORD)
+    parser.add_argument('--db', default='rentagirlfriend_bench')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--companion-ratio', type=float, default=0.3, help='share of users offering packages')
+    parser.add_argument('--packages', type=int, default=3, help='packages per companion')
+    parser.add_argument('--orders', type=int, default=10000)
+    parser.add_argument('--ratings', type=int, default=20000)
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--bcrypt-rounds', type=int, default=Config.BCRYPT_LOG_ROUNDS)
+    parser.add_argument('--login-password', default='bench-password')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--manifest', default=os.path.join(ROOT, 'bench', 'manifest.json'))
+    return parser.parse_args()
+
+
+def load_schema(cursor, path):
+    with open(path, encoding='utf-8') as f:
+        lines = [line for line in f if not line.startswith(('--', '/*!'))]
+    for statement in ''.join(lines).split(';\n'):
+        if statement.strip():
+            cursor.execute(statement)
+
+
+def insert_many(cursor, query, rows):
+    for start in range(0, len(rows), BATCH):
+        cursor.executemany(query, rows[start:start + BATCH])
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    # Highest worker id, unlikely to be one the app is running with
+    ids = SnowflakeGenerator(MAX_WORKER_ID)
+    next_id = lambda: format_id(ids.next_id())
+
+    conn = MySQLdb.connect(host=args.host, port=args.port, user=args.user, passwd=args.password,
+                           charset='utf8mb4')
+    cursor = conn.cursor()
+    cursor.execute(f"DROP DATABASE IF EXISTS `{args.db}`")
+    cursor.execute(f"CREATE DATABASE `{args.db}` CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci")
+    conn.select_db(args.db)
+    load_schema(cursor, SCHEMA)
+    conn.commit()
+
+    # One hash for everybody, at the app's cost so logins measure real work
+    password = bcrypt.hashpw(args.login_password.encode(), bcrypt.gensalt(args.bcrypt_rounds)).decode()
+
+    now = datetime.datetime.now()
+    users = []
+    for n in range(args.users):
+        users.append((next_id(), f"bench_{n}", f"bench_{n}@example.com", rng.randint(18, 40),
+                      rng.randint(150, 190), f"08{rng.randint(10**9, 10**10 - 1)}", None,
+                      password, rng.randint(0, 1), 0, now - datetime.timedelta(seconds=rng.randint(0, 365 * 86400))))
+    insert_many(cursor,
+                "INSERT INTO users (id, username, email, age, height, mobile_phone, profile_picture, password, gender, role, created_at) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", users)
+    user_ids = [user[0] for user in users]
+    companions = rng.sample(user_ids, int(len(user_ids) * args.companion_ratio))
+
+    packages = []
+    for companion in companions:
+        for _ in range(args.packages):
+            packages.append((next_id(), companion, rng.randrange(50000, 1000000, 5000),
+                             f"{rng.randint(1, 8):02d}:00:00", 1))
+    insert_many(cursor,
+                "INSERT INTO user_package (id, user_id, price, duration, available) VALUES (%s, %s, %s, %s, %s)",
+                packages)
+
+    # Past orders are closed so every package can still be booked
+    orders = []
+    if packages:
+        for _ in range(args.orders):
+            package = rng.choice(packages)
+            orders.append((next_id(), package[0], rng.choice(user_ids), package[2],
+                           rng.choice(('completed', 'completed', 'cancelled', 'expired'))))
+    insert_many(cursor,
+                "INSERT INTO orders (id, package_id, user_id, total_price, status) VALUES (%s, %s, %s, %s, %s)",
+                orders)
+
+    ratings = []
+    if companions:
+        for _ in range(args.ratings):
+            ratings.append((next_id(), rng.choice(companions), rng.choice(user_ids),
+                            rng.choices((1, 2, 3, 4, 5), weights=(1, 1, 3, 6, 9))[0], 'bench review'))
+    insert_many(cursor,
+                "INSERT INTO rating (id, gf_bf_id, user_id, rate, review) VALUES (%s, %s, %s, %s, %s)",
+                ratings)
+
+    messages = []
+    for _ in range(args.messages):
+        sender, recipient = rng.sample(user_ids, 2)
+        created_at = now - datetime.timedelta(seconds=rng.randint(0, 30 * 86400))
+        messages.append((next_id(), sender, recipient, 'bench message', int(rng.random() < 0.8), created_at))
+    insert_many(cursor,
+                "INSERT INTO messages (id, sender_id, recipient_id, message, is_read, created_at) "
+                "VALUES (%s, %s, %s, %s, %s, %s)", messages)
+
+    # Derived tables, the same values the app maintains incrementally
+    cursor.execute("""
+        INSERT INTO rating_summary (gf_bf_id, total_rate, total_count, rate_1, rate_2, rate_3, rate_4, rate_5)
+        SELECT gf_bf_id, SUM(rate), COUNT(*), SUM(rate = 1), SUM(rate = 2), SUM(rate = 3), SUM(rate = 4), SUM(rate = 5)
+        FROM rating GROUP BY gf_bf_id
+    """)
+    cursor.execute("""
+        INSERT INTO unread_counter (user_id, unread_count)
+        SELECT recipient_id, COUNT(*) FROM messages WHERE is_read = 0 GROUP BY recipient_id
+    """)
+    cursor.execute("""
+        INSERT INTO companion_search (user_id, gender, age, height, min_price, available_min_price, average_rate, total_count, created_at)
+        SELECT u.id, u.gender, u.age, u.height, MIN(p.price), MIN(CASE WHEN p.available THEN p.price END),
+               COALESCE(s.average_rate, 0), COALESCE(s.total_count, 0), u.created_at
+        FROM users u JOIN user_package p ON p.user_id = u.id LEFT JOIN rating_summary s ON s.gf_bf_id = u.id
+        GROUP BY u.id, u.gender, u.age, u.height, u.created_at, s.average_rate, s.total_count
+    """)
+    cursor.execute("DELETE FROM counters")
+    cursor.execute("INSERT INTO counters (name, shard, value) SELECT 'users', 0, COUNT(*) FROM users")
+    cursor.execute("INSERT INTO counters (name, shard, value) SELECT 'orders', 0, COUNT(*) FROM orders")
+    conn.commit()
+    cursor.execute("ANALYZE TABLE users, user_package, orders, rating, rating_summary, companion_search, messages")
+    cursor.fetchall()
+    cursor.close()
+    conn.close()
+
+    with open(args.manifest, 'w', encoding='utf-8') as f:
+        json.dump({
+            'db': args.db,
+            'password': args.login_password,
+            'usernames': [user[1] for user in users],
+            'user_ids': user_ids,
+            'companions': companions,
+            'packages': [package[0] for package in packages],
+        }, f)
+
+    print(f"Seeded {args.db}: {len(users)} users, {len(packages)} packages, {len(orders)} orders, "
+          f"{len(ratings)} ratings, {len(messages)} messages")
+    print(f"Manifest written to {args.manifest}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+
+# Small thread-safe LRU with a per-entry expiry
+class TTLCache:
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            value, expires_at = item
+            if expires_at <= now:
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'maxsize': self.maxsize,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+# Backends for the response cache. Invalidation bumps a per-namespace
+# generation that is part of every key, so old entries are never read again
+# and simply age out.
+class MemoryCacheBackend:
+    def __init__(self, maxsize=1024, ttl=30):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value, ttl=None):
+        self._cache.set(key, value, ttl)
+
+    def generations(self, namespaces):
+        with self._lock:
+            return [self._generations.get(namespace, 0) for namespace in namespaces]
+
+    def bump(self, namespace):
+        with self._lock:
+            self._generations[namespace] = self._generations.get(namespace, 0) + 1
+
+    def stats(self):
+        return self._cache.stats()
+
+
+# Shared between worker processes, so an invalidation in one is seen by all
+class RedisCacheBackend:
+    def __init__(self, url, ttl=30, prefix='rentagf:cache:'):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self._redis.get(self.prefix + key)
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self._redis.set(self.prefix + key, pickle.dumps(value), ex=ttl or self.ttl)
+
+    def generations(self, namespaces):
+        values = self._redis.mget([f"{self.prefix}gen:{namespace}" for namespace in namespaces])
+        return [int(value or 0) for value in values]
+
+    def bump(self, namespace):
+        self._redis.incr(f"{self.prefix}gen:{namespace}")
+
+    def stats(self):
+        return {}
+
+
+def create_response_cache(app):
+    backend = app.config.get('RESPONSE_CACHE_BACKEND', 'memory')
+    ttl = app.config.get('RESPONSE_CACHE_TTL', 30)
+    if backend == 'redis':
+        return RedisCacheBackend(app.config['RESPONSE_CACHE_REDIS_URL'], ttl=ttl)
+    if backend == 'memory':
+        return MemoryCacheBackend(app.config.get('RESPONSE_CACHE_SIZE', 1024), ttl=ttl)
+    raise ValueError(f"Unknown RESPONSE_CACHE_BACKEND {backend!r}")
@@ -1,11 +1,162 @@
+import os
+
 class Config:
     MYSQL_HOST = 'localhost'
     MYSQL_USER = 'dream'
     MYSQL_PASSWORD = 'dream'
     MYSQL_DB = 'rentagirlfriend'
+    MYSQL_PORT = 3306
+    MYSQL_CHARSET = 'utf8mb4'
+
+    # Request threads per process, gunicorn.conf.py reads the same WEB_THREADS.
+    # Admission control, chat streams and password hashing are sized from it.
+    WEB_THREADS = int(os.environ.get('WEB_THREADS', 8))
+
+    # Connection pool
+    MYSQL_POOL_MIN_SIZE = 2
+    MYSQL_POOL_MAX_SIZE = 10
+    MYSQL_POOL_TIMEOUT = 5          # seconds to wait for a free connection
+    MYSQL_POOL_MAX_LIFETIME = 3600  # seconds before a connection is recycled
+    MYSQL_POOL_PING_ON_BORROW = True
+
+    # Password hashing worker pool
+    BCRYPT_LOG_ROUNDS = 12
+    HASH_WORKERS = 4
+    HASH_QUEUE_DEPTH = 16  # hashes allowed to wait before answering 429
+    HASH_TIMEOUT = 10
+    # Request threads that may wait on a hash at once, None is half of
+    # WEB_THREADS. Caps HASH_WORKERS + HASH_QUEUE_DEPTH so a login storm
+    # can't block every request thread.
+    HASH_MAX_CALLERS = None
+
+    # Auth caches (per process)
+    TOKEN_CACHE_SIZE = 10000
+    TOKEN_CACHE_TTL = 300
+    ROLE_CACHE_SIZE = 10000
+    # Role changes are invalidated through RESPONSE_CACHE_BACKEND: with
+    # 'redis' every worker sees them at once, with 'memory' other worker
+    # processes keep the old role for up to ROLE_CACHE_TTL seconds.
+    ROLE_CACHE_TTL = 60
+
+    # Chat push channel, 'memory' for a single process or 'redis' to fan out
+    # across worker processes. Every open stream holds one worker thread, so
+    # a process keeps at most SSE_MAX_STREAMS open (None: a quarter of
+    # WEB_THREADS) and answers 503 past that; clients poll the thread endpoint
+    # meanwhile. Serve more streams from their own gunicorn, see README.
+    PUBSUB_BACKEND = 'memory'
+    PUBSUB_REDIS_URL = 'redis://localhost:6379/0'
+    PUBSUB_QUEUE_SIZE = 100
+    SSE_HEARTBEAT = 15
+    SSE_MAX_STREAMS = None
+
+    # Keyset pagination for list endpoints
+    PAGE_LIMIT_DEFAULT = 100
+    PAGE_LIMIT_MAX = 1000
+    SEARCH_MAX_OFFSET = 10000
+
+    # Response cache for public reads. 'memory' is per process, so other
+    # workers may serve a stale body for up to the TTL; 'redis' is shared.
+    RESPONSE_CACHE_BACKEND = 'memory'
+    RESPONSE_CACHE_REDIS_URL = 'redis://localhost:6379/1'
+    RESPONSE_CACHE_SIZE = 1024
+    RESPONSE_CACHE_TTL = 30
+
+    # Id generator. WORKER_ID None means the WORKER_ID env var (set per worker
+    # by gunicorn.conf.py), or a slot leased in ids.py. Hosts sharing a
+    # database each need their own WORKER_ID_BASE block (env, see ids.py).
+    # ID_STORAGE 'bigint' after running DB/migrations/005_bigint_ids.sql
+    WORKER_ID = None
+    ID_STORAGE = 'varchar'
+
+    # Maintained row counters (users, orders)
+    COUNTER_SHARDS = 8
+    COUNTER_RECONCILE_INTERVAL = 3600  # seconds, 0 disables the background job
+
+    # Log a warning when one request runs the same statement this many times
+    N_PLUS_ONE_THRESHOLD = 10
+
+    # Max items per bulk request
+    BULK_MAX_ITEMS = 5000
+
+    # Availability slots. The max length bounds the index range every lookup
+    # by time reads, keep it close to the longest real booking.
+    SLOT_MAX_HOURS = 12
+    SLOT_WINDOW_MAX_DAYS = 31
+
+    # Slow query log: statements over SLOW_QUERY_MS are logged with the types
+    # of their params, and EXPLAINed once when SLOW_QUERY_EXPLAIN is on
+    SLOW_QUERY_MS = 200
+    SLOW_QUERY_EXPLAIN = False
+    QUERY_STATS_MAX_STATEMENTS = 500
+
+    # Rate limits, token buckets per client IP and per logged in user. Each
+    # rule is {'ip' or 'user': (requests, per seconds)}, the bucket holds
+    # `requests` tokens. 'memory' counts per process, 'redis' is shared.
+    RATE_LIMIT_ENABLED = True
+    RATE_LIMIT_BACKEND = 'memory'
+    RATE_LIMIT_REDIS_URL = 'redis://localhost:6379/2'
+    RATE_LIMIT_MAX_KEYS = 100000
+    RATE_LIMITS = {
+        'login': {'ip': (10, 60)},
+        'register': {'ip': (5, 3600)},
+        'password': {'user': (5, 3600), 'ip': (20, 3600)},
+        'message': {'user': (30, 60), 'ip': (120, 60)},
+        'write': {'user': (60, 60), 'ip': (300, 60)},
+    }
+    # Reverse proxies in front of the app setting X-Forwarded-For, 0 trusts none
+    PROXY_COUNT = 0
+
+    # Admission control: requests one process serves at once, the rest get
+    # 503 after waiting ADMISSION_WAIT seconds for a slot instead of queueing
+    # on the connection pool. None means the smaller of WEB_THREADS and
+    # MYSQL_POOL_MAX_SIZE minus the background borrowers (JOB_WORKERS, the
+    # counter reconciler, /metrics).
+    ADMISSION_MAX_IN_FLIGHT = None
+    ADMISSION_WAIT = 0.05
+
+    # Background jobs (order expiry/completion, notifications) in the jobs
+    # table. Every app process runs JOB_WORKERS threads, 0 leaves the jobs to
+    # python worker.py. A claimed job is retried after JOB_LEASE seconds if
+    # its worker died, failures back off from JOB_BACKOFF_BASE up to
+    # JOB_BACKOFF_MAX seconds and give up after JOB_MAX_ATTEMPTS.
+    JOB_WORKERS = 2
+    JOB_POLL_INTERVAL = 1.0
+    JOB_BATCH_SIZE = 10
+    JOB_LEASE = 60
+    JOB_MAX_ATTEMPTS = 5
+    JOB_BACKOFF_BASE = 5
+    JOB_BACKOFF_MAX = 600
+    # Queue depth in /metrics is read from the table at most this often (seconds)
+    JOB_METRICS_TTL = 15
+
+    # Seconds a pending order waits for the companion before it expires
+    ORDER_PENDING_TTL = 1800
 
 class DevelopmentConfig(Config):
     DEBUG = True
+    SLOW_QUERY_EXPLAIN = True
 
 class ProductionConfig(Config):
     DEBUG = False
+
+    MYSQL_HOST = os.environ.get('MYSQL_HOST', Config.MYSQL_HOST)
+    MYSQL_USER = os.environ.get('MYSQL_USER', Config.MYSQL_USER)
+    MYSQL_PASSWORD = os.environ.get('MYSQL_PASSWORD', Config.MYSQL_PASSWORD)
+    MYSQL_DB = os.environ.get('MYSQL_DB', Config.MYSQL_DB)
+    MYSQL_PORT = int(os.environ.get('MYSQL_PORT', Config.MYSQL_PORT))
+
+    SLOW_QUERY_MS = int(os.environ.get('SLOW_QUERY_MS', Config.SLOW_QUERY_MS))
+    SLOW_QUERY_EXPLAIN = os.environ.get('SLOW_QUERY_EXPLAIN', '') == '1'
+
+    RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') == '1'
+    RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', Config.RATE_LIMIT_BACKEND)
+    RATE_LIMIT_REDIS_URL = os.environ.get('RATE_LIMIT_REDIS_URL', Config.RATE_LIMIT_REDIS_URL)
+    PROXY_COUNT = int(os.environ.get('PROXY_COUNT', Config.PROXY_COUNT))
+    SSE_MAX_STREAMS = int(os.environ['SSE_MAX_STREAMS']) if os.environ.get('SSE_MAX_STREAMS') else None
+
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', Config.JOB_WORKERS))
+    ORDER_PENDING_TTL = int(os.environ.get('ORDER_PENDING_TTL', Config.ORDER_PENDING_TTL))
+
+    # Keep at least as many connections as gunicorn threads per worker
+    MYSQL_POOL_MIN_SIZE = int(os.environ.get('MYSQL_POOL_MIN_SIZE', 4))
+    MYSQL_POOL_MAX_SIZE = int(os.environ.get('MYSQL_POOL_MAX_SIZE', 16))
@@ -0,0 +1,298 @@
+import queue
+import re
+import threading
+import time
+import MySQLdb
+from flask import g
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# One physical connection plus the bookkeeping the pool needs
+class PooledConnection:
+    __slots__ = ('conn', 'created_at', 'borrowed_at')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.borrowed_at = None
+
+
+class ConnectionPool:
+    def __init__(self, connect_args, min_size=1, max_size=10, timeout=5.0,
+                 max_lifetime=3600, ping_on_borrow=True):
+        self.connect_args = connect_args
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.ping_on_borrow = ping_on_borrow
+
+        # LIFO keeps the hot connections hot and lets the idle ones age out
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._size = 0
+        self._closed = False
+
+        # Metrics
+        self._in_use = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._created = 0
+        self._discarded = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._hold_total = 0.0
+        self._hold_max = 0.0
+
+    def _connect(self):
+        entry = PooledConnection(MySQLdb.connect(**self.connect_args))
+        with self._lock:
+            self._created += 1
+        return entry
+
+    def _discard(self, entry):
+        try:
+            entry.conn.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._size -= 1
+            self._discarded += 1
+
+    def _expired(self, entry):
+        return self.max_lifetime and time.monotonic() - entry.created_at > self.max_lifetime
+
+    def _healthy(self, entry):
+        if self._expired(entry):
+            return False
+        if self.ping_on_borrow:
+            try:
+                entry.conn.ping()
+            except MySQLdb.Error:
+                return False
+        return True
+
+    # Open connections up to min_size, used at startup
+    def warm(self):
+        while True:
+            with self._lock:
+                if self._closed or self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                entry = self._connect()
+            except Exception:
+                with self._lock:
+                    self._size -= 1
+                raise
+            self._idle.put(entry)
+
+    def acquire(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        while True:
+            if self._closed:
+                raise PoolTimeout('Connection pool is closed')
+            try:
+                entry = self._idle.get_nowait()
+            except queue.Empty:
+                entry = None
+
+            if entry is None:
+                with self._lock:
+                    grow = self._size < self.max_size
+                    if grow:
+                        self._size += 1
+                if grow:
+                    try:
+                        entry = self._connect()
+                    except Exception:
+                        with self._lock:
+                            self._size -= 1
+                        raise
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        with self._lock:
+                            self._timeouts += 1
+                        raise PoolTimeout('Timed out waiting for a database connection')
+                    try:
+                        entry = self._idle.get(timeout=remaining)
+                    except queue.Empty:
+                        continue
+
+            if not self._healthy(entry):
+                self._discard(entry)
+                continue
+
+            now = time.monotonic()
+            entry.borrowed_at = now
+            waited = now - start
+            with self._lock:
+                self._in_use += 1
+                self._checkouts += 1
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+            return entry
+
+    def release(self, entry):
+        held = time.monotonic() - entry.borrowed_at
+        with self._lock:
+            self._in_use -= 1
+            self._hold_total += held
+            self._hold_max = max(self._hold_max, held)
+
+        # Never hand out a connection with someone else's open transaction
+        try:
+            entry.conn.rollback()
+        except Exception:
+            self._discard(entry)
+            return
+
+        if self._closed or self._expired(entry):
+            self._discard(entry)
+        else:
+            self._idle.put(entry)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                entry = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(entry)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self._size,
+                'in_use': self._in_use,
+                'idle': self._idle.qsize(),
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'checkouts_total': self._checkouts,
+                'timeouts_total': self._timeouts,
+                'created_total': self._created,
+                'discarded_total': self._discarded,
+                'wait_seconds_total': round(self._wait_total, 6),
+                'wait_seconds_max': round(self._wait_max, 6),
+                'checkout_seconds_total': round(self._hold_total, 6),
+                'checkout_seconds_max': round(self._hold_max, 6),
+            }
+
+
+# Statement shape used to group queries: whitespace collapsed and IN lists of
+# any length folded into one
+_IN_LIST = re.compile(r"\(\s*%s(\s*,\s*%s)+\s*\)")
+_VALUES_LIST = re.compile(r"(\(\s*%s(\s*,\s*%s)*\s*\))(\s*,\s*\(\s*%s(\s*,\s*%s)*\s*\))+")
+_SPACES = re.compile(r"\s+")
+
+def normalize_statement(query):
+    if isinstance(query, bytes):
+        query = query.decode(errors='replace')
+    query = _SPACES.sub(' ', query).strip()
+    query = _VALUES_LIST.sub(r"\1, ...", query)
+    return _IN_LIST.sub('(%s, ...)', query)
+
+
+# Times every execute and hands it to the pool's query hooks
+class InstrumentedCursor:
+    def __init__(self, cursor, connection, hooks):
+        self._cursor = cursor
+        self._connection = connection
+        self._hooks = hooks
+
+    def _timed(self, method, query, args):
+        start = time.perf_counter()
+        try:
+            return method(query, args)
+        finally:
+            elapsed = time.perf_counter() - start
+            for hook in self._hooks:
+                hook(self._connection, self._cursor, query, args, elapsed)
+
+    def execute(self, query, args=None):
+        return self._timed(self._cursor.execute, query, args)
+
+    def executemany(self, query, args):
+        return self._timed(self._cursor.executemany, query, args)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class InstrumentedConnection:
+    def __init__(self, conn, hooks):
+        self._conn = conn
+        self._hooks = hooks
+
+    def cursor(self, cursorclass=None):
+        return InstrumentedCursor(self._conn.cursor(cursorclass), self._conn, self._hooks)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+# Drop-in replacement for flask_mysqldb.MySQL: mysql.connection borrows one
+# pooled connection per app context and gives it back on teardown
+class MySQLPool:
+    def __init__(self, app=None):
+        self.app = None
+        self.pool = None
+        self._lock = threading.Lock()
+        # hook(connection, cursor, query, args, seconds), called after every execute
+        self.query_hooks = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.teardown_appcontext(self.teardown)
+
+    def get_pool(self):
+        if self.pool is None:
+            with self._lock:
+                if self.pool is None:
+                    config = self.app.config
+                    connect_args = {
+                        'host': config.get('MYSQL_HOST', 'localhost'),
+                        'user': config.get('MYSQL_USER'),
+                        'passwd': config.get('MYSQL_PASSWORD'),
+                        'db': config.get('MYSQL_DB'),
+                        'port': config.get('MYSQL_PORT', 3306),
+                        'charset': config.get('MYSQL_CHARSET', 'utf8mb4'),
+                        'connect_timeout': config.get('MYSQL_CONNECT_TIMEOUT', 10),
+                    }
+                    self.pool = ConnectionPool(
+                        connect_args,
+                        min_size=config.get('MYSQL_POOL_MIN_SIZE', 1),
+                        max_size=config.get('MYSQL_POOL_MAX_SIZE', 10),
+                        timeout=config.get('MYSQL_POOL_TIMEOUT', 5.0),
+                        max_lifetime=config.get('MYSQL_POOL_MAX_LIFETIME', 3600),
+                        ping_on_borrow=config.get('MYSQL_POOL_PING_ON_BORROW', True),
+                    )
+        return self.pool
+
+    @property
+    def connection(self):
+        if 'db_entry' not in g:
+            g.db_entry = self.get_pool().acquire()
+            g.db_connection = InstrumentedConnection(g.db_entry.conn, self.query_hooks)
+        return g.db_connection
+
+    def teardown(self, exception):
+        g.pop('db_connection', None)
+        entry = g.pop('db_entry', None)
+        if entry is not None:
+            self.pool.release(entry)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
@@ -0,0 +1,62 @@
+import multiprocessing
+import os
+
+# gunicorn -c gunicorn.conf.py wsgi:app
+bind = os.environ.get('BIND', '0.0.0.0:3002')
+
+# Processes x threads, each thread serves one request at a time. Chat streams
+# (/api/message/stream) hold a thread for as long as they are open, at most
+# SSE_MAX_STREAMS of them per process (config.py).
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 8))
+
+# On SIGTERM workers stop accepting and get graceful_timeout seconds to
+# finish in-flight requests before they are killed
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 30))
+timeout = int(os.environ.get('WORKER_TIMEOUT', 60))
+keepalive = 5
+
+# Recycle workers now and then so leaks can't build up
+max_requests = int(os.environ.get('MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.environ.get('MAX_REQUESTS_JITTER', 1000))
+
+# Import the app in each worker, so pools and threads are created after fork
+preload_app = False
+
+accesslog = os.environ.get('ACCESS_LOG', '-')
+errorlog = '-'
+
+
+# Snowflake worker ids (ids.py) are WORKER_ID_BASE + slot. Every host that
+# shares a database gets its own block of WORKER_ID_SLOTS ids (host 0 base 0,
+# host 1 base 64, ...). Each live worker holds the lowest free slot of its
+# host and a respawned worker takes over the slot of the one that died, so
+# ids stay inside the block however often workers are recycled. The block
+# must fit twice the workers, a reload runs old and new ones side by side.
+worker_id_base = int(os.environ.get('WORKER_ID_BASE', 0))
+worker_id_slots = int(os.environ.get('WORKER_ID_SLOTS', 64))
+_worker_id_slots = {}  # slot -> worker, kept by the master
+
+
+def pre_fork(server, worker):
+    slot = next((n for n in range(worker_id_slots) if n not in _worker_id_slots), None)
+    if slot is None or worker_id_base + slot > 1023:
+        raise RuntimeError('No free Snowflake worker id, raise WORKER_ID_SLOTS or lower the worker count')
+    _worker_id_slots[slot] = worker
+    worker.worker_id_slot = slot
+
+
+def post_fork(server, worker):
+    os.environ['WORKER_ID'] = str(worker_id_base + worker.worker_id_slot)
+
+
+def child_exit(server, worker):
+    slot = getattr(worker, 'worker_id_slot', None)
+    if _worker_id_slots.get(slot) is worker:
+        del _worker_id_slots[slot]
+
+
+def worker_exit(server, worker):
+    from main import shutdown
+    shutdown()
@@ -0,0 +1,99 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import bcrypt
+
+
+class HasherBusy(Exception):
+    pass
+
+
+# bcrypt releases the GIL while hashing, so a small thread pool runs hashes in
+# parallel. Every queued hash blocks the request thread that asked for it, so
+# at most max_callers (half of WEB_THREADS by default) may wait at once and the
+# rest get HasherBusy; the other half keeps serving everything else.
+class PasswordHasher:
+    def __init__(self, app=None):
+        self.rounds = 12
+        self.workers = 4
+        self.queue_depth = 16
+        self.timeout = 10
+        self.max_callers = 4
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._rejected = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.rounds = app.config.get('BCRYPT_LOG_ROUNDS', self.rounds)
+        self.workers = app.config.get('HASH_WORKERS', self.workers)
+        self.queue_depth = app.config.get('HASH_QUEUE_DEPTH', self.queue_depth)
+        self.timeout = app.config.get('HASH_TIMEOUT', self.timeout)
+        self.max_callers = app.config.get('HASH_MAX_CALLERS') or max(1, app.config.get('WEB_THREADS', 8) // 2)
+
+    @property
+    def slots(self):
+        return min(self.workers + self.queue_depth, self.max_callers)
+
+    # Created lazily so forked workers don't inherit dead threads
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._slots = threading.BoundedSemaphore(self.slots)
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                        thread_name_prefix='bcrypt')
+        return self._executor
+
+    def _done(self, future):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def _run(self, fn, *args):
+        executor = self._get_executor()
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise HasherBusy('Password hashing queue is full')
+        with self._lock:
+            self._in_flight += 1
+        try:
+            future = executor.submit(fn, *args)
+        except Exception:
+            self._done(None)
+            raise
+        future.add_done_callback(self._done)
+        return future.result(timeout=self.timeout)
+
+    def warm(self):
+        self._get_executor()
+
+    def hash(self, password):
+        if isinstance(password, str):
+            password = password.encode()
+        return self._run(lambda p: bcrypt.hashpw(p, bcrypt.gensalt(self.rounds)), password).decode()
+
+    def check(self, password, hashed):
+        if isinstance(password, str):
+            password = password.encode()
+        if isinstance(hashed, str):
+            hashed = hashed.encode()
+        return self._run(bcrypt.checkpw, password, hashed)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queue_depth': self.queue_depth,
+                'slots': self.slots,
+                'in_flight': self._in_flight,
+                'rejected_total': self._rejected,
+            }
@@ -0,0 +1,116 @@
+import os
+import tempfile
+import threading
+import time
+
+# Snowflake layout: 41 bits of milliseconds since EPOCH_MS, 10 bits worker id,
+# 12 bits sequence. Ids from one worker only grow, so inserts append to the
+# end of the primary key B-tree.
+EPOCH_MS = 1735689600000  # 2025-01-01 00:00:00 UTC
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+# Width of the decimal form, 2^63 has 19 digits. Zero padding keeps string
+# order equal to numeric order in varchar columns.
+ID_WIDTH = 20
+
+
+class SnowflakeGenerator:
+    def __init__(self, worker_id, epoch_ms=EPOCH_MS):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"worker_id must be between 0 and {MAX_WORKER_ID}")
+        self.worker_id = worker_id
+        self.epoch_ms = epoch_ms
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+
+    def _wait_until(self, ms):
+        now = time.time_ns() // 1000000
+        while now < ms:
+            time.sleep((ms - now) / 1000)
+            now = time.time_ns() // 1000000
+        return now
+
+    def next_id(self):
+        with self._lock:
+            now = time.time_ns() // 1000000
+            if now < self._last_ms:
+                # Clock stepped back, hold until it passes the last id again
+                now = self._wait_until(self._last_ms)
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # 4096 ids in this millisecond already
+                    now = self._wait_until(self._last_ms + 1)
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            return ((now - self.epoch_ms) << (WORKER_BITS + SEQUENCE_BITS)) | \
+                   (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+
+def format_id(value):
+    return str(value).zfill(ID_WIDTH)
+
+
+# Without WORKER_ID (uvicorn, python main.py, worker.py) a process leases the
+# lowest free slot of its host: an exclusive lock on a file in
+# WORKER_ID_LOCK_DIR, held until the process exits. The id is
+# WORKER_ID_BASE + slot, give every host sharing a database its own block of
+# WORKER_ID_SLOTS like gunicorn.conf.py does.
+_lease_file = None
+
+
+def lease_worker_id():
+    global _lease_file
+    try:
+        import fcntl
+    except ImportError:
+        # No flock (Windows), only good for a single process
+        return os.getpid() & MAX_WORKER_ID
+    base = int(os.environ.get('WORKER_ID_BASE', 0))
+    slots = int(os.environ.get('WORKER_ID_SLOTS', 64))
+    directory = os.environ.get('WORKER_ID_LOCK_DIR', os.path.join(tempfile.gettempdir(), 'rentagf-worker-ids'))
+    os.makedirs(directory, exist_ok=True)
+    for slot in range(min(slots, MAX_WORKER_ID + 1 - base)):
+        f = open(os.path.join(directory, f"{base + slot}.lock"), 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            continue
+        if _lease_file is not None:
+            _lease_file.close()
+        _lease_file = f
+        return base + slot
+    raise RuntimeError('No free Snowflake worker id, raise WORKER_ID_SLOTS')
+
+
+# Worker id from WORKER_ID (config or environment), otherwise leased
+def resolve_worker_id(configured=None):
+    if configured is None:
+        configured = os.environ.get('WORKER_ID')
+    if configured is not None:
+        return int(configured)
+    return lease_worker_id()
+
+
+_generator = None
+_generator_pid = None
+_generator_lock = threading.Lock()
+
+
+# One generator per process, rebuilt after fork so workers forked from a
+# preloaded app don't share a worker id
+def get_generator(worker_id=None):
+    global _generator, _generator_pid
+    pid = os.getpid()
+    if _generator is None or _generator_pid != pid:
+        with _generator_lock:
+            if _generator is None or _generator_pid != pid:
+                _generator = SnowflakeGenerator(resolve_worker_id(worker_id))
+                _generator_pid = pid
+    return _generator
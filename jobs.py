@@ -0,0 +1,208 @@
+import datetime
+import json
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# Jobs live in the jobs table, so they survive restarts and any app process
+# (or python worker.py) can run them. A worker claims due jobs with
+# SELECT ... FOR UPDATE SKIP LOCKED and leases them by moving run_at
+# JOB_LEASE seconds ahead; a job whose worker died is due again once the
+# lease runs out. The handler runs in one transaction with the delete of
+# the job, so its database work happens once. Side effects outside the
+# database (publishing to the broker) are at least once.
+class JobQueue:
+    def __init__(self, get_pool, app=None):
+        self.get_pool = get_pool
+        self.workers = 2
+        self.poll_interval = 1.0
+        self.batch_size = 10
+        self.lease = 60
+        self.max_attempts = 5
+        self.backoff_base = 5
+        self.backoff_max = 600
+        self.handlers = {}
+        # hook(kind, outcome, waited, seconds) after every run, outcome is done, retry or failed
+        self.hooks = []
+        self._threads = []
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._processed = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.workers = app.config.get('JOB_WORKERS', self.workers)
+        self.poll_interval = app.config.get('JOB_POLL_INTERVAL', self.poll_interval)
+        self.batch_size = app.config.get('JOB_BATCH_SIZE', self.batch_size)
+        self.lease = app.config.get('JOB_LEASE', self.lease)
+        self.max_attempts = app.config.get('JOB_MAX_ATTEMPTS', self.max_attempts)
+        self.backoff_base = app.config.get('JOB_BACKOFF_BASE', self.backoff_base)
+        self.backoff_max = app.config.get('JOB_BACKOFF_MAX', self.backoff_max)
+
+    # @jobs.handler('kind') registers fn(cursor, payload)
+    def handler(self, kind):
+        def decorator(fn):
+            self.handlers[kind] = fn
+            return fn
+        return decorator
+
+    # Queue a job in the caller's transaction, it only exists once that commits.
+    # A job is dropped when one with the same dedupe_key is still in the table.
+    def enqueue(self, cursor, kind, payload, delay=0, run_at=None, dedupe_key=None):
+        self.enqueue_many(cursor, kind, [(payload, dedupe_key)], delay, run_at)
+
+    # items are (payload, dedupe_key or None)
+    def enqueue_many(self, cursor, kind, items, delay=0, run_at=None):
+        now = datetime.datetime.now()
+        if run_at is None:
+            run_at = now + datetime.timedelta(seconds=max(0, delay))
+        rows = [(kind, json.dumps(payload), run_at, self.max_attempts, dedupe_key, now) for payload, dedupe_key in items]
+        if rows:
+            cursor.executemany(
+                "INSERT INTO jobs (kind, payload, status, run_at, attempts, max_attempts, dedupe_key, created_at) "
+                "VALUES (%s, %s, 'queued', %s, 0, %s, %s, %s) ON DUPLICATE KEY UPDATE id = id",
+                rows)
+
+    def claim(self, connection):
+        now = datetime.datetime.now()
+        cursor = connection.cursor()
+        try:
+            cursor.execute(
+                "SELECT id, kind, payload, attempts, max_attempts, run_at FROM jobs "
+                "WHERE status IN ('queued', 'running') AND run_at <= %s "
+                "ORDER BY run_at LIMIT %s FOR UPDATE SKIP LOCKED",
+                (now, self.batch_size))
+            rows = cursor.fetchall()
+            if rows:
+                ids = tuple(row[0] for row in rows)
+                placeholders = ', '.join(['%s'] * len(ids))
+                cursor.execute(
+                    f"UPDATE jobs SET status = 'running', attempts = attempts + 1, run_at = %s WHERE id IN ({placeholders})",
+                    (now + datetime.timedelta(seconds=self.lease), ) + ids)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+        return [(job_id, kind, payload, attempts + 1, max_attempts, (now - run_at).total_seconds())
+                for job_id, kind, payload, attempts, max_attempts, run_at in rows]
+
+    def run_job(self, connection, job):
+        job_id, kind, payload, attempts, max_attempts, waited = job
+        start = time.perf_counter()
+        cursor = connection.cursor()
+        try:
+            handler = self.handlers.get(kind)
+            if handler is None:
+                raise LookupError(f"No handler for job {kind!r}")
+            handler(cursor, json.loads(payload))
+            cursor.execute("DELETE FROM jobs WHERE id = %s", (job_id, ))
+            connection.commit()
+            outcome = 'done'
+        except Exception as e:
+            connection.rollback()
+            error = f"{type(e).__name__}: {e}"[:1000]
+            if attempts >= max_attempts:
+                cursor.execute("UPDATE jobs SET status = 'failed', last_error = %s WHERE id = %s", (error, job_id))
+                outcome = 'failed'
+                logger.exception('Job %s %s failed for good after %d attempts', job_id, kind, attempts)
+            else:
+                # Exponential backoff with jitter so failed jobs don't retry in lockstep
+                backoff = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1)) * random.uniform(0.5, 1)
+                cursor.execute(
+                    "UPDATE jobs SET status = 'queued', run_at = %s, last_error = %s WHERE id = %s",
+                    (datetime.datetime.now() + datetime.timedelta(seconds=backoff), error, job_id))
+                outcome = 'retry'
+                logger.warning('Job %s %s failed (attempt %d), retrying in %.0fs: %s', job_id, kind, attempts, backoff, error)
+            connection.commit()
+        finally:
+            cursor.close()
+
+        with self._lock:
+            self._processed[outcome] = self._processed.get(outcome, 0) + 1
+        for hook in self.hooks:
+            hook(kind, outcome, waited, time.perf_counter() - start)
+
+    # Claim and run one batch, returns how many jobs ran
+    def run_once(self, connection):
+        jobs = self.claim(connection)
+        for job in jobs:
+            self.run_job(connection, job)
+        return len(jobs)
+
+    def _run(self):
+        while not self._stop.is_set():
+            ran = 0
+            try:
+                pool = self.get_pool()
+                entry = pool.acquire()
+                try:
+                    ran = self.run_once(entry.conn)
+                finally:
+                    pool.release(entry)
+            except Exception:
+                logger.exception('Job worker error')
+            # A full batch means more are probably due
+            if ran < self.batch_size:
+                self._stop.wait(self.poll_interval)
+
+    def start(self, workers=None):
+        workers = self.workers if workers is None else workers
+        self._stop.clear()
+        for n in range(workers):
+            thread = threading.Thread(target=self._run, name=f"jobs-{n}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    # Workers finish the job they are running, then exit
+    def stop(self, timeout=10):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+        self._threads = []
+
+    # Queue depth per kind and status, with the age of the oldest due job
+    def stats(self, connection):
+        now = datetime.datetime.now()
+        cursor = connection.cursor()
+        try:
+            cursor.execute(
+                "SELECT kind, status, COUNT(*), SUM(run_at <= %s), MIN(run_at) FROM jobs GROUP BY kind, status",
+                (now, ))
+            queues = [{
+                'kind': kind,
+                'status': status,
+                'count': count,
+                'due': int(due or 0),
+                'oldest_due_seconds': max(0.0, (now - oldest).total_seconds()) if due else 0.0,
+            } for kind, status, count, due, oldest in cursor.fetchall()]
+        finally:
+            cursor.close()
+        with self._lock:
+            processed = dict(self._processed)
+        return {
+            'workers': len(self._threads),
+            'processed_total': processed,
+            'queues': queues,
+        }
+
+    # Put failed jobs back in the queue, all of them or the given ids
+    def retry_failed(self, connection, ids=None):
+        cursor = connection.cursor()
+        try:
+            query = "UPDATE jobs SET status = 'queued', attempts = 0, run_at = %s WHERE status = 'failed'"
+            params = (datetime.datetime.now(), )
+            if ids:
+                query += f" AND id IN ({', '.join(['%s'] * len(ids))})"
+                params += tuple(ids)
+            cursor.execute(query, params)
+            connection.commit()
+            return cursor.rowcount
+        finally:
+            cursor.close()
@@ -1,17 +1,30 @@
 import os
-from flask import Flask, request, jsonify
-from flask_mysqldb import MySQL
+import json
+import math
+import random
+from flask import Flask, request, jsonify, Response, stream_with_context, url_for, make_response, send_from_directory, g, has_request_context
 import MySQLdb.cursors
 import hashlib
-from config import *
 import datetime
-import random
-import bcrypt
+import time
+import threading
 import jwt
-from werkzeug.utils import secure_filename
 from flask_bcrypt import check_password_hash
 from functools import wraps
 from flask_cors import CORS
+from db import MySQLPool, PoolTimeout, normalize_statement
+from hashing import PasswordHasher, HasherBusy
+from cache import TTLCache, create_response_cache
+from pubsub import create_broker
+from ids import get_generator, format_id
+from uploads import store_upload, discard_upload, thumbnail_path, ThumbnailWorker
+from collections import Counter as StatementCounter
+from metrics import Registry
+from querylog import QueryLog
+from serialize import dumps, json_response
+from ratelimit import RateLimited, ConcurrencyLimiter, create_rate_limiter
+from jobs import JobQueue
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 # Initiation Flask
 app = Flask(__name__)
@@ -22,11 +35,16 @@ CORS(app, resources={r"/api/*": {
     "origins": ["http://localhost:3000"],
     "methods": ["GET", "POST", "PUT", "DELETE"],
     "allowed_headers": ["*"],
+    "expose_headers": ["Link", "X-Next-Cursor", "X-Prev-Cursor"],
     "supports_credentials": True
 }})
 
-# Load DB config
-app.config.from_object(DevelopmentConfig)
+# Load config, APP_CONFIG picks the class (wsgi.py defaults to ProductionConfig)
+app.config.from_object(os.environ.get('APP_CONFIG', 'config.DevelopmentConfig'))
+
+# Client IP from X-Forwarded-For when running behind PROXY_COUNT proxies
+if app.config['PROXY_COUNT']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_COUNT'])
 
 # Key for JWT
 app.config['SECRET_KEY'] = 'girlfriendsecretkey'
@@ -34,14 +52,282 @@ app.config['SECRET_KEY'] = 'girlfriendsecretkey'
 # File Upload Setting
 app.config['UPLOAD_FOLDER'] = 'uploads/profile_pictures'
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg'}
-
-mysql = MySQL(app)
+app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024
+app.config['THUMBNAIL_SIZES'] = (64, 256)
+
+# Thumbnails for uploaded profile pictures, made off the request thread
+thumbnails = ThumbnailWorker(app.config['UPLOAD_FOLDER'], app.config['THUMBNAIL_SIZES'])
+
+# Pooled MySQL connections, one borrowed per request
+mysql = MySQLPool(app)
+
+@app.errorhandler(PoolTimeout)
+def pool_timeout(e):
+    return jsonify({'error': 'Server is busy, try again later !! '}), 503
+
+# Password hashing runs on a bounded worker pool
+hasher = PasswordHasher(app)
+
+@app.errorhandler(HasherBusy)
+def hasher_busy(e):
+    response = jsonify({'error': 'Too many requests, try again later !! '})
+    response.headers['Retry-After'] = '1'
+    return response, 429
+
+# Push channel for chat, memory or redis backend (PUBSUB_BACKEND)
+broker = create_broker(app)
+
+# Background jobs kept in the jobs table (order expiry, completion, notifications)
+jobs = JobQueue(mysql.get_pool, app)
+
+# Cache for public read endpoints, memory or redis backend (RESPONSE_CACHE_BACKEND)
+response_cache = create_response_cache(app)
+
+# Drop every cached response of the given namespaces, call after commit
+def invalidate(*namespaces):
+    for namespace in namespaces:
+        response_cache.bump(namespace)
+
+# Cache 200 responses per URL with an ETag, answer If-None-Match with 304.
+# The key carries the namespace generations read before the view runs, so a
+# write that lands meanwhile can't leave a stale body behind.
+def cached_response(*namespaces):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            generations = response_cache.generations(namespaces)
+            key = f"{request.full_path}:{':'.join(map(str, generations))}"
+            entry = response_cache.get(key)
+            if entry is None:
+                response = make_response(func(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                body = response.get_data()
+                entry = (body, response.mimetype, hashlib.sha1(body).hexdigest())
+                response_cache.set(key, entry)
+
+            body, mimetype, etag = entry
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                response = Response(body, mimetype=mimetype)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
+
+# **** Metrics ****
+metrics = Registry()
+http_requests = metrics.counter('http_requests_total', 'Requests by route and status', ('method', 'route', 'status'))
+http_latency = metrics.histogram('http_request_duration_seconds', 'Request latency by route', ('method', 'route'))
+http_in_flight = metrics.gauge('http_requests_in_flight', 'Requests being served')
+db_queries = metrics.histogram('db_queries_per_request', 'Queries run per request', ('route', ),
+                               buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+db_time = metrics.counter('db_query_seconds_total', 'Time spent in queries by route', ('route', ))
+db_repeated = metrics.counter('db_repeated_statement_total', 'Requests running one statement N_PLUS_ONE_THRESHOLD times or more', ('route', ))
+pool_gauge = metrics.gauge('db_pool', 'Connection pool state', ('stat', ))
+hasher_gauge = metrics.gauge('password_hasher', 'Password hashing pool state', ('stat', ))
+sse_gauge = metrics.gauge('sse_subscribers', 'Open chat streams in this process')
+job_runs = metrics.counter('jobs_processed_total', 'Background jobs run by kind and outcome', ('kind', 'outcome'))
+job_wait = metrics.histogram('job_wait_seconds', 'Time a job waited past its run_at before a worker took it', ('kind', ),
+                             buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 300, 900))
+job_duration = metrics.histogram('job_duration_seconds', 'Job run time', ('kind', ))
+job_depth = metrics.gauge('jobs', 'Jobs in the table by kind and status', ('kind', 'status'))
+job_lag = metrics.gauge('jobs_oldest_due_seconds', 'Age of the oldest due job by kind and status', ('kind', 'status'))
+
+def record_job(kind, outcome, waited, seconds):
+    job_runs.inc(kind, outcome)
+    job_wait.observe(kind, value=max(0.0, waited))
+    job_duration.observe(kind, value=seconds)
+
+jobs.hooks.append(record_job)
+
+@metrics.collector
+def collect_pools():
+    if mysql.pool is not None:
+        for stat, value in mysql.pool.stats().items():
+            pool_gauge.set(stat, value=value)
+    for stat, value in hasher.stats().items():
+        hasher_gauge.set(stat, value=value)
+    sse_gauge.set(value=broker.subscriber_count())
+
+# Queue depth is shared by all processes, read from the table at most once
+# every JOB_METRICS_TTL seconds per process however often /metrics is scraped
+job_queue_cache = TTLCache(maxsize=1, ttl=app.config['JOB_METRICS_TTL'])
+
+@metrics.collector
+def collect_jobs():
+    if mysql.pool is None:
+        return
+    queues = job_queue_cache.get('queues')
+    if queues is None:
+        try:
+            queues = jobs.stats(mysql.connection)['queues']
+        except Exception:
+            app.logger.exception('Could not read job queue depth')
+            return
+        job_queue_cache.set('queues', queues)
+    job_depth.clear()
+    job_lag.clear()
+    for queue in queues:
+        job_depth.set(queue['kind'], queue['status'], value=queue['count'])
+        job_lag.set(queue['kind'], queue['status'], value=queue['oldest_due_seconds'])
+
+def request_route():
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+# Per request query count/time, grouped by statement to spot N+1 loops
+def record_query(connection, cursor, query, args, seconds):
+    if has_request_context() and 'db_statements' in g:
+        g.db_query_count += 1
+        g.db_query_time += seconds
+        g.db_statements[normalize_statement(query)] += 1
+
+mysql.query_hooks.append(record_query)
+
+# Process wide stats per statement, slow ones logged (and EXPLAINed)
+query_log = QueryLog(threshold_ms=app.config['SLOW_QUERY_MS'],
+                     explain=app.config['SLOW_QUERY_EXPLAIN'],
+                     max_statements=app.config['QUERY_STATS_MAX_STATEMENTS'])
+mysql.query_hooks.append(query_log)
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    g.db_query_count = 0
+    g.db_query_time = 0.0
+    g.db_statements = StatementCounter()
+    http_in_flight.inc()
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_start' not in g:
+        return response
+    route = request_route()
+    http_requests.inc(request.method, route, response.status_code)
+    http_latency.observe(request.method, route, value=time.perf_counter() - g.request_start)
+    db_queries.observe(route, value=g.db_query_count)
+    db_time.inc(route, amount=g.db_query_time)
+    statement, count = max(g.db_statements.items(), key=lambda item: item[1], default=(None, 0))
+    if count >= app.config['N_PLUS_ONE_THRESHOLD']:
+        db_repeated.inc(route)
+        app.logger.warning('Possible N+1 on %s %s: %d x %s', request.method, route, count, statement)
+    return response
+
+@app.teardown_request
+def end_request_metrics(exception):
+    if g.pop('request_start', None) is not None:
+        http_in_flight.dec()
+
+# Prometheus scrape endpoint, values are per worker process
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# **** Rate limiting / Admission control ****
+# Token buckets for RATE_LIMITS, memory or redis backend (RATE_LIMIT_BACKEND)
+rate_limiter = create_rate_limiter(app)
+rate_limited_total = metrics.counter('rate_limited_total', 'Requests refused by a rate limit', ('rule', 'key'))
+
+@app.errorhandler(RateLimited)
+def rate_limited(e):
+    response = jsonify({'error': 'Too many requests, try again later !! '})
+    response.headers['Retry-After'] = str(max(1, math.ceil(e.retry_after)))
+    return response, 429
+
+# Take a token from every bucket of the rule before the view runs. Put it
+# under @token_required so the user id is known.
+def rate_limit(rule):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if app.config['RATE_LIMIT_ENABLED']:
+                keys = {'ip': request.remote_addr, 'user': kwargs.get('id')}
+                for kind, (requests, period) in app.config['RATE_LIMITS'].get(rule, {}).items():
+                    if keys.get(kind) is None:
+                        continue
+                    allowed, retry_after = rate_limiter.take(f"{rule}:{kind}:{keys[kind]}", requests / period, requests)
+                    if not allowed:
+                        rate_limited_total.inc(rule, kind)
+                        raise RateLimited(retry_after)
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Pool connections borrowed outside admitted requests: job workers, the
+# counter reconciler and the /metrics job queue read
+def background_borrowers():
+    return app.config['JOB_WORKERS'] + (1 if app.config['COUNTER_RECONCILE_INTERVAL'] else 0) + 1
+
+# Requests served at once by this process, no more than there are request
+# threads and within what the pool has left after the background borrowers
+def admission_limit():
+    if app.config['ADMISSION_MAX_IN_FLIGHT']:
+        return app.config['ADMISSION_MAX_IN_FLIGHT']
+    return max(1, min(app.config['WEB_THREADS'], app.config['MYSQL_POOL_MAX_SIZE'] - background_borrowers()))
+
+admission = ConcurrencyLimiter(admission_limit(), wait=app.config['ADMISSION_WAIT'])
+admission_rejected = metrics.counter('admission_rejected_total', 'Requests shed by admission control', ('route', ))
+admission_gauge = metrics.gauge('admission', 'Admission control state', ('stat', ))
+
+# Long lived streams would hold a slot for their whole life, the rest don't
+# touch the DB (/metrics only reads the job queue every JOB_METRICS_TTL seconds)
+ADMISSION_EXEMPT = {'message_stream', 'prometheus_metrics', 'uploaded_file', 'home', 'static'}
+
+@metrics.collector
+def collect_admission():
+    for stat, value in admission.stats().items():
+        admission_gauge.set(stat, value=value)
+
+@app.before_request
+def admit_request():
+    if request.method == 'OPTIONS' or request.endpoint in ADMISSION_EXEMPT:
+        return None
+    if not admission.acquire():
+        admission_rejected.inc(request_route())
+        response = jsonify({'error': 'Server is busy, try again later !! '})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+    g.admitted = True
+
+@app.teardown_request
+def release_admission(exception):
+    if g.pop('admitted', False):
+        admission.release()
+
+# Chat streams skip admission but hold a request thread each, capped on their own
+stream_limiter = ConcurrencyLimiter(app.config['SSE_MAX_STREAMS'] or max(1, app.config['WEB_THREADS'] // 4))
+stream_gauge = metrics.gauge('sse_streams', 'Chat stream limit state', ('stat', ))
+
+@metrics.collector
+def collect_streams():
+    for stat, value in stream_limiter.stats().items():
+        stream_gauge.set(stat, value=value)
+
+# Verified JWT payloads, each kept no longer than the token's own exp
+token_cache = TTLCache(maxsize=app.config['TOKEN_CACHE_SIZE'], ttl=app.config['TOKEN_CACHE_TTL'])
+
+# user id -> role. Entries are keyed with the user's "role:<id>" generation in
+# the response cache backend, so invalidate() after an admin updates or
+# deletes the user reaches every process when that backend is redis.
+role_cache = TTLCache(maxsize=app.config['ROLE_CACHE_SIZE'], ttl=app.config['ROLE_CACHE_TTL'])
+
+def decode_token(token):
+    data = token_cache.get(token)
+    if data is None:
+        data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
+        ttl = app.config['TOKEN_CACHE_TTL']
+        if 'exp' in data:
+            ttl = min(ttl, data['exp'] - time.time())
+        token_cache.set(token, data, ttl)
+    return data
 
 def token_required(func):
     def wrapper(*args, **kwargs):
         token = request.headers.get('Authorization').split(' ')[1]
         try:
-            data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
+            data = decode_token(token)
             return func(*args, **kwargs, id=data['id'])
         except jwt.ExpiredSignatureError:
             return jsonify({'error': 'Token has expired'}), 401
@@ -50,16 +336,27 @@ def token_required(func):
     wrapper.__name__ = func.__name__
     return wrapper
 
+# Role lookup, None if the user doesn't exist
+def get_role(id):
+    generation, = response_cache.generations((f"role:{id}", ))
+    key = f"{id}:{generation}"
+    role = role_cache.get(key)
+    if role is None:
+        cursor = mysql.connection.cursor()
+        try:
+            cursor.execute("SELECT role FROM users WHERE id = %s", (id, ))
+            data = cursor.fetchone()
+        finally:
+            cursor.close()
+        if not data:
+            return None
+        role = data[0]
+        role_cache.set(key, role)
+    return role
+
 #Function Admin check
 def is_admin(id):
-    cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
-    cursor.execute("SELECT * FROM users WHERE id = %s", (id, ))
-    data = cursor.fetchone()
-
-    if data['role'] == 1:
-        return True
-    else:
-        return False
+    return get_role(id) == 1
 
 
 # Validation function method
@@ -67,48 +364,239 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
-# Generate unique number
+# MySQL error code for unique key violations
+DUPLICATE_ENTRY = 1062
+
+# Message for a username/email already taken, None for any other error
+def duplicate_user_message(e):
+    if not isinstance(e, MySQLdb.IntegrityError) or e.args[0] != DUPLICATE_ENTRY:
+        return None
+    if 'users_email' in str(e):
+        return 'Email is already registered!!'
+    if 'users_username' in str(e):
+        return 'Username is already registered!!'
+    return None
+
+# Ids sent in request bodies as str, None when it isn't an id. Compare them
+# with str() of what MySQL returns, an int with ID_STORAGE 'bigint'.
+def bulk_id(value):
+    if isinstance(value, bool) or not isinstance(value, (str, int)) or value in ('', 0):
+        return None
+    return str(value)
+
+# Generate unique number (Snowflake id, see ids.py)
 def generate_unique_number():
-    # Get time
-    now = datetime.datetime.now()
-    timestamp = now.strftime('%Y%m%d%H%M%S%f')
-
-    # generate random number
-    random_number = random.randint(1000, 9999)
+    unique_number = get_generator(app.config['WORKER_ID']).next_id()
+    if app.config['ID_STORAGE'] == 'bigint':
+        return unique_number
+    return format_id(unique_number)
+
+# Keyset pagination args (?limit=&after=)
+def get_page_args():
+    limit = request.args.get('limit', app.config['PAGE_LIMIT_DEFAULT'], type=int)
+    limit = max(1, min(limit, app.config['PAGE_LIMIT_MAX']))
+    after = request.args.get('after')
+    return limit, after
+
+# Append "id > after" to a query so the page is read from the primary key
+def keyset_query(query, after, params=()):
+    if after:
+        query += " AND id > %s" if " WHERE " in query else " WHERE id > %s"
+        params = params + (after, )
+    return query + " ORDER BY id", params
+
+# Client asked for NDJSON (?format=ndjson or Accept: application/x-ndjson)
+def wants_stream():
+    return request.args.get('format') == 'ndjson' or \
+           request.accept_mimetypes.best == 'application/x-ndjson'
+
+# Columns each resource sends to clients, in table order. Password hashes
+# never leave the server.
+USER_COLUMNS = "id, username, email, age, height, mobile_phone, profile_picture, gender, role"
+PACKAGE_COLUMNS = "id, user_id, price, duration, available"
+RATING_COLUMNS = "id, gf_bf_id, user_id, rate, review"
+ORDER_COLUMNS = "id, package_id, user_id, total_price, status"
+
+# Stream rows one per line from an unbuffered server-side cursor
+def stream_rows(query, params=(), cursorclass=MySQLdb.cursors.SSCursor):
+    if 'limit' in request.args:
+        limit, _ = get_page_args()
+        query += " LIMIT %s"
+        params = params + (limit, )
+
+    def generate():
+        cursor = mysql.connection.cursor(cursorclass)
+        try:
+            cursor.execute(query, params)
+            for row in cursor:
+                yield dumps(row) + b'\n'
+        finally:
+            cursor.close()
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+# Rows were fetched with LIMIT limit + 1, the extra row tells us there is a next page
+def page_response(rows, limit, key, cursor_arg='after'):
+    response = json_response(list(rows[:limit]))
+    if len(rows) > limit:
+        next_cursor = key(rows[limit - 1])
+        args = request.args.to_dict()
+        args.update({cursor_arg: next_cursor, 'limit': limit})
+        next_url = url_for(request.endpoint, _external=True, **request.view_args, **args)
+        response.headers['X-Next-Cursor'] = str(next_cursor)
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+    return response, 200
+
+# **** Counters ****
+# Row counts kept in the counters table, spread over a few shard rows so
+# concurrent writers don't queue on a single row lock
+COUNTED_TABLES = {'users': 'users', 'orders': 'orders'}
+
+# Add delta to a counter, in the caller's transaction
+def bump_counter(cursor, name, delta):
+    if delta:
+        cursor.execute(
+            "INSERT INTO counters (name, shard, value) VALUES (%s, %s, %s) ON DUPLICATE KEY UPDATE value = value + VALUES(value)",
+            (name, random.randrange(app.config['COUNTER_SHARDS']), delta))
+
+def read_counter(cursor, name):
+    cursor.execute("SELECT CAST(COALESCE(SUM(value), 0) AS SIGNED) FROM counters WHERE name = %s", (name, ))
+    return cursor.fetchone()[0]
+
+# Compare counters with COUNT(*) in one consistent snapshot and apply the
+# difference as a delta, so writes running meanwhile are not lost. The named
+# lock keeps two workers from applying the same correction twice.
+def reconcile_counters(connection):
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT GET_LOCK('counter_reconcile', 0)")
+        if not cursor.fetchone()[0]:
+            return None
+        try:
+            drift = {}
+            cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+            for name, table in COUNTED_TABLES.items():
+                cursor.execute(f"SELECT COUNT(*) FROM {table}")
+                actual = cursor.fetchone()[0]
+                drift[name] = actual - read_counter(cursor, name)
+            connection.commit()
+
+            for name, delta in drift.items():
+                bump_counter(cursor, name, delta)
+            connection.commit()
+            return drift
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK('counter_reconcile')")
+    finally:
+        cursor.close()
 
-    # Combine timestamp with random number
-    unique_number = f"{timestamp}{random_number}"
-    return unique_number
+# Periodic reconciliation in a daemon thread, every COUNTER_RECONCILE_INTERVAL seconds
+def start_counter_reconciler():
+    interval = app.config['COUNTER_RECONCILE_INTERVAL']
+    if not interval:
+        return
+
+    def run():
+        while True:
+            time.sleep(interval)
+            pool = mysql.get_pool()
+            try:
+                entry = pool.acquire()
+                try:
+                    drift = reconcile_counters(entry.conn)
+                finally:
+                    pool.release(entry)
+                if drift and any(drift.values()):
+                    app.logger.warning('Counter drift corrected: %s', drift)
+            except Exception:
+                app.logger.exception('Counter reconciliation failed')
+    threading.Thread(target=run, name='counter-reconciler', daemon=True).start()
+
+@app.route('/api/admin/counters/reconcile', methods=['POST'])
+@token_required
+def admin_reconcile_counters(id):
+    if not is_admin(id):
+        return jsonify({'error': 'Bad request !! '}), 401
+    try:
+        drift = reconcile_counters(mysql.connection)
+        if drift is None:
+            return jsonify({'message': 'Reconciliation already running !! '}), 409
+        invalidate('users_total', 'orders_total')
+        return jsonify({'drift': drift}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/api/users/total', methods=['GET'])
+@cached_response('users_total')
 def total_users():
     cursor = mysql.connection.cursor()
     try:
-        cursor.execute("SELECT COUNT(*) FROM users")
-        data = cursor.fetchone()
-        return jsonify(data)
+        return jsonify([read_counter(cursor, 'users')])
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
         cursor.close()
 
 @app.route('/api/orders/total', methods=['GET'])
+@cached_response('orders_total')
 def total_orders():
     cursor = mysql.connection.cursor()
     try:
-        cursor.execute("SELECT COUNT(*) FROM orders")
-        data = cursor.fetchone()
-        return jsonify(data)
+        return jsonify([read_counter(cursor, 'orders')])
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
         cursor.close()
 
+# DB pool metrics
+@app.route('/api/admin/db/pool', methods=['GET'])
+@token_required
+def db_pool_stats(id):
+    if not is_admin(id):
+        return jsonify({'error': 'Bad request !! '}), 401
+    return jsonify(mysql.get_pool().stats()), 200
+
+# Statements by total time, with the EXPLAIN of the slow ones
+@app.route('/api/admin/db/queries', methods=['GET'])
+@token_required
+def db_query_stats(id):
+    if not is_admin(id):
+        return jsonify({'error': 'Bad request !! '}), 401
+    limit = min(request.args.get('limit', 50, type=int), app.config['QUERY_STATS_MAX_STATEMENTS'])
+    return jsonify(query_log.report(limit)), 200
+
+@app.route('/api/admin/db/queries', methods=['DELETE'])
+@token_required
+def db_query_stats_reset(id):
+    if not is_admin(id):
+        return jsonify({'error': 'Bad request !! '}), 401
+    query_log.reset()
+    return jsonify({'message': 'Query stats cleared'}), 200
+
+# Job queue depth and wait per kind/status, and what this process ran
+@app.route('/api/admin/jobs', methods=['GET'])
+@token_required
+def job_stats(id):
+    if not is_admin(id):
+        return jsonify({'error': 'Bad request !! '}), 401
+    return jsonify(jobs.stats(mysql.connection)), 200
+
+# Queue failed jobs again, body {"ids": [...]} or empty for all of them
+@app.route('/api/admin/jobs/retry', methods=['POST'])
+@token_required
+def job_retry(id):
+    if not is_admin(id):
+        return jsonify({'error': 'Bad request !! '}), 401
+    ids = (request.get_json(silent=True) or {}).get('ids')
+    if ids is not None and not isinstance(ids, list):
+        return jsonify({'error': 'ids must be a list !! '}), 400
+    return jsonify({'retried': jobs.retry_failed(mysql.connection, ids)}), 200
+
 # Users
 @app.route('/api/home', methods=['GET'])
 def home():
     return jsonify({'message': 'API RENTAL PACAR '})
 @app.route('/api/register', methods=['POST'])
+@rate_limit('register')
 def register():
     data = request.json
     #input validation
@@ -121,29 +609,32 @@ def register():
     age = data['age']
     height = data['height']
     phone = data['mobile_phone']
-    password = data['password'].encode() #Encrypt Pass
+    password = data['password']
     gender = data['gender']
     role = data['role']
     try:
-        hashed_password = bcrypt.hashpw(password, bcrypt.gensalt())
-        cur = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
-        cur.execute("SELECT * FROM users WHERE username = %s OR email = %s", (username, email))
-        existing_user = cur.fetchone()
-
-        if existing_user:
-            if existing_user['username'] == username:
-                return jsonify({'error': 'Username is already registered!!'})
-            if existing_user['email'] == email:
-                return jsonify({'error': 'Email is already registered!!'})
-            
-        cur.execute("INSERT INTO users VALUES (%s, %s, %s, %s, %s, %s, NULL, %s, %s, %s)", (user_id, username, email, age, height, phone, hashed_password.decode(), gender, role))
+        hashed_password = hasher.hash(password) #Encrypt Pass
+        cur = mysql.connection.cursor()
+        # Unique keys on username/email reject duplicates, no check-then-insert race
+        try:
+            cur.execute("INSERT INTO users (id, username, email, age, height, mobile_phone, profile_picture, password, gender, role) VALUES (%s, %s, %s, %s, %s, %s, NULL, %s, %s, %s)", (user_id, username, email, age, height, phone, hashed_password, gender, role))
+        except MySQLdb.IntegrityError as e:
+            message = duplicate_user_message(e)
+            if message is None:
+                raise
+            return jsonify({'error': message})
+        bump_counter(cur, 'users', 1)
         mysql.connection.commit()
+        invalidate('users_total')
         return jsonify({'message': 'Registrasion Succesfully!'}), 201
+    except HasherBusy as e:
+        return hasher_busy(e)
     except Exception as e:
         return jsonify({'error': 'An error occurred on the server!!', 'details': str(e)}), 500
     
 
 @app.route('/api/login', methods=['POST'])
+@rate_limit('login')
 def login():
     data = request.json
     
@@ -152,20 +643,19 @@ def login():
         return jsonify({'error': 'Incomplete Data !!'}), 400
 
     username = data['username']
-    password = data['password'].encode() 
+    password = data['password']
 
     try:
         cur = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
-        cur.execute("SELECT * FROM users WHERE username = %s", (username, ))
+        cur.execute("SELECT id, role, password FROM users WHERE username = %s", (username, ))
         user = cur.fetchone()
-        id = user['id']
-        role = user['role']
         if not user:
             return jsonify({'error': 'User not found!!'}), 404
+        id = user['id']
+        role = user['role']
         
         # Password verify
-        hashed_password = user['password'].encode()
-        if bcrypt.checkpw(password, hashed_password):
+        if hasher.check(password, user['password']):
             # Generate JWT Token
             token = jwt.encode({
                 'id': id,
@@ -177,6 +667,8 @@ def login():
             return jsonify({'message': 'Login successfully !!', 'token': token}), 200
         else:
             return jsonify({'error': 'Wrong password !!'}), 401
+    except HasherBusy as e:
+        return hasher_busy(e)
     except Exception as e:
         return jsonify({'error': 'Internal server error !! ', 'details': str(e)}), 500
         
@@ -201,33 +693,31 @@ def protected(func):
     return wrapper
 
 @app.route('/api/edit-profile', methods=['POST'])
-# @token_required
+@token_required
+@rate_limit('write')
 def edit_profile(id):
+    # multipart form when a picture is sent, JSON otherwise
+    data = request.form if request.files or request.form else request.get_json(silent=True) or {}
+    new_username = data.get('username')
+    new_email = data.get('email')
+    new_age = data.get('age')
+    new_height = data.get('height')
+    new_phone = data.get('mobile_phone')
+
+    if not new_username or not new_email or not new_age or not new_height or not new_phone:
+        return jsonify({'error' : 'Incomplete data !! '}), 400
+
+    file_path = None
+    created = False
     if 'profile_picture' in request.files:
-        file = request['profile_picture']
+        file = request.files['profile_picture']
         if file and allowed_file(file.filename):
-            # Keep filename safe
-            filename = secure_filename(file.filename)
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-
-            # Save file to folder
-            file.save(file_path)
+            # Stored under its content hash, identical pictures are kept once
+            extension = file.filename.rsplit('.', 1)[1].lower()
+            relative, created = store_upload(file.stream, app.config['UPLOAD_FOLDER'], extension)
+            file_path = os.path.join(app.config['UPLOAD_FOLDER'], relative).replace(os.sep, '/')
         else:
             return jsonify({'error' : 'Invalid file type !! '}), 400
-    else:
-        file_path = None
-    
-    data = request.json #get data from form
-    new_username = data['username']
-    new_email = data['email']
-    new_age = data['age']
-    new_height = data['height']
-    new_phone = data['mobile_phone']
-
-    print(new_username)
-
-    if not new_username or not new_email or not new_age or not new_height or not new_phone:
-        return jsonify({'error' : 'Incomplete data !! '}), 400
     
     cursor = mysql.connection.cursor()
 
@@ -240,7 +730,10 @@ def edit_profile(id):
             cursor.execute(
                 "UPDATE users SET username = %s, email = %s, age = %s, height = %s, mobile_phone = %s WHERE id = %s", 
                 (new_username, new_email, new_age, new_height, new_phone, id))
+        refresh_companion_search(cursor, [id])
         mysql.connection.commit()
+        if created:
+            thumbnails.submit(relative)
 
         return jsonify({
             'message': 'Profile update successfully',
@@ -249,25 +742,50 @@ def edit_profile(id):
             'update_age': new_age,
             'update_height': new_height,
             'update_phone': new_phone,
-            'update_picture': file_path
+            'update_picture': file_path,
+            'update_thumbnails': {
+                str(size): os.path.join(app.config['UPLOAD_FOLDER'], thumbnail_path(relative, size)).replace(os.sep, '/')
+                for size in app.config['THUMBNAIL_SIZES']
+            } if file_path and thumbnails.enabled else None
         }), 200
+    except MySQLdb.IntegrityError as e:
+        mysql.connection.rollback()
+        if created:
+            discard_upload(app.config['UPLOAD_FOLDER'], relative)
+        message = duplicate_user_message(e)
+        return jsonify({'error': message or str(e)}), 409 if message else 500
     except Exception as e:
+        mysql.connection.rollback()
+        if created:
+            discard_upload(app.config['UPLOAD_FOLDER'], relative)
         return jsonify({'error': str(e)}), 500
     finally:
         cursor.close()
-    
+
+# Profile pictures and thumbnails. Names are content hashes so they never
+# change and can be cached forever; in production let nginx serve this folder.
+@app.route('/uploads/profile_pictures/<path:filename>', methods=['GET'])
+def uploaded_file(filename):
+    response = send_from_directory(os.path.abspath(app.config['UPLOAD_FOLDER']), filename, max_age=31536000)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
 
 # ADMIN Get All Users
 @app.route('/api/admin/users', methods=['GET'])
 # @token_required
 def get_all_users():
+    limit, after = get_page_args()
+    query, params = keyset_query(f"SELECT {USER_COLUMNS} FROM users", after)
+    if wants_stream():
+        return stream_rows(query, params, MySQLdb.cursors.SSDictCursor)
+
     cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
     try:
-        cursor.execute("SELECT * FROM users")
+        cursor.execute(query + " LIMIT %s", params + (limit + 1, ))
         data = cursor.fetchall()
-        if not data:
+        if not data and not after:
             return jsonify({'message': 'Users not found !! '}), 404
-        return jsonify(data), 200
+        return page_response(data, limit, lambda row: row['id'])
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -279,11 +797,11 @@ def get_all_users():
 def get_user_by_id(id):
     cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
     try:
-        cursor.execute("SELECT * FROM users WHERE id = %s", (id, ))
+        cursor.execute(f"SELECT {USER_COLUMNS} FROM users WHERE id = %s", (id, ))
         data = cursor.fetchone()
         if not data:
             return jsonify({'message': 'User not found !! '}), 404
-        return jsonify(data), 200
+        return json_response(data), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -307,54 +825,99 @@ def admin_update_user(id):
     
     cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
     try:
-        cursor.execute("SELECT * FROM users WHERE id = %s", (id, ))
+        cursor.execute("SELECT id FROM users WHERE id = %s", (id, ))
         user = cursor.fetchone()
         if not user:
             return jsonify({'error': 'User not found !! '}), 404
 
         if new_password:
-            hashed_password = bcrypt.hashpw(new_password.encode(), bcrypt.gensalt())
+            hashed_password = hasher.hash(new_password)
             cursor.execute(
                 "UPDATE users SET username = %s, email = %s, age = %s, height = %s, mobile_phone = %s, role = %s, password = %s WHERE id = %s",
-                (new_username, new_email, new_age, new_height, new_phone, new_role, hashed_password.decode(), id)
+                (new_username, new_email, new_age, new_height, new_phone, new_role, hashed_password, id)
             )
         else:
             cursor.execute(
                 "UPDATE users SET username = %s, email = %s, age = %s, height = %s, mobile_phone = %s, role = %s WHERE id = %s",
                 (new_username, new_email, new_age, new_height, new_phone, new_role, id)
             )
+        refresh_companion_search(cursor, [id])
         mysql.connection.commit()
+        invalidate(f"role:{id}")
         return jsonify({'message': 'Data updated successfully !! '}), 200
+    except HasherBusy as e:
+        return hasher_busy(e)
+    except MySQLdb.IntegrityError as e:
+        mysql.connection.rollback()
+        message = duplicate_user_message(e)
+        return jsonify({'error': message or str(e)}), 409 if message else 500
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
         cursor.close()
 
+# Delete users and everything that points at them in one transaction,
+# set based so the cost is a fixed number of statements whatever len(user_ids)
+def delete_users(cursor, user_ids):
+    ids = tuple(user_ids)
+    placeholders = ', '.join(['%s'] * len(ids))
+    try:
+        # Their calendars go, slots their orders booked are free again
+        release_slots(cursor, f"o.user_id IN ({placeholders})", ids)
+        cursor.execute(f"DELETE FROM availability_slots WHERE companion_id IN ({placeholders})", ids)
+
+        # Orders placed by the users and orders placed on their packages
+        cursor.execute(f"DELETE FROM orders WHERE user_id IN ({placeholders})", ids)
+        deleted_orders = cursor.rowcount
+        cursor.execute(f"""
+            DELETE o FROM orders o JOIN user_package p ON p.id = o.package_id
+            WHERE p.user_id IN ({placeholders})
+        """, ids)
+        deleted_orders += cursor.rowcount
+        bump_counter(cursor, 'orders', -deleted_orders)
+        cursor.execute(f"DELETE FROM user_package WHERE user_id IN ({placeholders})", ids)
+
+        cursor.execute(f"""
+            UPDATE unread_counter c JOIN (
+                SELECT recipient_id, COUNT(*) AS unread FROM messages
+                WHERE sender_id IN ({placeholders}) AND is_read = 0 GROUP BY recipient_id
+            ) d ON d.recipient_id = c.user_id
+            SET c.unread_count = GREATEST(c.unread_count - d.unread, 0)
+        """, ids)
+        cursor.execute(f"DELETE FROM unread_counter WHERE user_id IN ({placeholders})", ids)
+        cursor.execute(f"DELETE FROM messages WHERE sender_id IN ({placeholders})", ids)
+        cursor.execute(f"DELETE FROM messages WHERE recipient_id IN ({placeholders})", ids)
+
+        remove_rating_aggregates(cursor, f"user_id IN ({placeholders}) AND gf_bf_id NOT IN ({placeholders})", ids + ids)
+        cursor.execute(f"DELETE FROM rating_summary WHERE gf_bf_id IN ({placeholders})", ids)
+        cursor.execute(f"DELETE FROM rating WHERE user_id IN ({placeholders})", ids)
+        cursor.execute(f"DELETE FROM rating WHERE gf_bf_id IN ({placeholders})", ids)
+        cursor.execute(f"DELETE FROM companion_search WHERE user_id IN ({placeholders})", ids)
+
+        cursor.execute(f"DELETE FROM users WHERE id IN ({placeholders})", ids)
+        deleted = cursor.rowcount
+        bump_counter(cursor, 'users', -deleted)
+        mysql.connection.commit()
+        invalidate('users_total', 'orders_total', 'user_package', 'rating')
+    except Exception:
+        mysql.connection.rollback()
+        raise
+
+    invalidate(*(f"role:{user_id}" for user_id in ids))
+    return deleted
+
 # ADMIN DELETE User
 @app.route('/api/admin/user/delete/<string:user_id>', methods=['DELETE'])
 # @token_required
 def admin_delete_user(user_id):
-    cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
-    try:
-        cursor.execute("SELECT * FROM users WHERE id = %s", (user_id, ))
-        data = cursor.fetchone()
-
-        if data['role'] == 1:
-            cursor.execute("DELETE FROM orders WHERE user_id = %s", (user_id, ))
-            mysql.connection.commit()
-
-            cursor.execute("DELETE FROM user_package WHERE user_id = %s", (user_id, ))
-            mysql.connection.commit()
-
-            cursor.execute("DELETE FROM messages WHERE sender_id = %s OR recipient_id = %s", (user_id, user_id))
-            mysql.connection.commit()
-
-            cursor.execute("DELETE FROM rating WHERE user_id = %s OR gf_bf_id = %s", (user_id, user_id))
-            mysql.connection.commit()
-
-            cursor.execute("DELETE FROM users WHERE id = %s", (user_id, ))
-            mysql.connection.commit()
+    role = get_role(user_id)
+    if role is None:
+        return jsonify({'error': 'User not found !! '}), 404
 
+    cursor = mysql.connection.cursor()
+    try:
+        if role == 1:
+            delete_users(cursor, [user_id])
             return jsonify({'message': 'User deleted successfully !! '}), 200
         else:
             return jsonify({'error': 'Bad request !! '}), 400
@@ -362,40 +925,70 @@ def admin_delete_user(user_id):
         return jsonify({'error': str(e)}), 500
     finally:
         cursor.close()
-        
+
+# ADMIN DELETE many Users, body: {"ids": [...]}
+@app.route('/api/admin/users/delete', methods=['POST'])
+@token_required
+def admin_delete_users(id):
+    if not is_admin(id):
+        return jsonify({'error': 'Bad request !! '}), 401
+
+    data = request.get_json(silent=True) or {}
+    ids = data.get('ids')
+    if not isinstance(ids, list) or not ids:
+        return jsonify({'error': 'ids must be a non empty list !! '}), 400
+    if len(ids) > app.config['PAGE_LIMIT_MAX']:
+        return jsonify({'error': 'Too many ids !! '}), 400
+    ids = [bulk_id(user_id) for user_id in ids]
+    if None in ids:
+        return jsonify({'error': 'ids must be strings or numbers !! '}), 400
+
+    cursor = mysql.connection.cursor()
+    try:
+        placeholders = ', '.join(['%s'] * len(ids))
+        cursor.execute(f"SELECT id FROM users WHERE id IN ({placeholders})", tuple(ids))
+        found = [row[0] for row in cursor.fetchall()]
+        not_found = sorted(set(ids) - {str(user_id) for user_id in found})
+        deleted = delete_users(cursor, found) if found else 0
+        return jsonify({'deleted': deleted, 'not_found': not_found}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cursor.close()
 
 
 @app.route('/api/change-password', methods=['PUT'])
 @token_required
+@rate_limit('password')
 def change_password(id):
     data = request.json
-    old_pass = data['old_password'].encode()
-    new_pass = data['new_password'].encode()
+    old_pass = data['old_password']
+    new_pass = data['new_password']
 
     if not old_pass or not new_pass:
         return jsonify({'error': 'Both old and new passwords are required'}), 400
     cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
 
     try:
-        cursor.execute("SELECT * FROM users WHERE id = %s", (id, ))
+        cursor.execute("SELECT password FROM users WHERE id = %s", (id, ))
         user = cursor.fetchone()
         if not user:
             return jsonify({'error': 'User not found !! '}), 404
         
-        db_pass = user['password'].encode()
-
         # Verify old pass
-        if bcrypt.checkpw(old_pass, db_pass):
-            hashed_password = bcrypt.hashpw(new_pass, bcrypt.gensalt())
+        if hasher.check(old_pass, user['password']):
+            hashed_password = hasher.hash(new_pass)
 
             cursor.execute(
                 "UPDATE users SET password = %s WHERE id = %s",
-                (hashed_password.decode(), id)
+                (hashed_password, id)
             )
             mysql.connection.commit()
             return jsonify({'message': 'Password change successfully !! '}), 200
         else:
             return jsonify({'error': 'Old password is incorrect !! '}), 401
+    except HasherBusy as e:
+        return hasher_busy(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -403,10 +996,113 @@ def change_password(id):
 
 # 
 
+# **** Companion Search ****
+# companion_search holds one row per user with packages: the user columns the
+# search filters on, the cheapest package (any / available) and the rating.
+# Every sort has an index alone and behind gender (009_companion_search_table.sql),
+# so a page is read in index order instead of sorting every match.
+SEARCH_SORTS = {
+    'newest': 'c.created_at',  # when the user registered, ids don't sort by time
+    'rating': 'c.average_rate',
+    'price': None,  # the price column the filters use
+    'age': 'c.age',
+    'height': 'c.height',
+}
+
+# Rebuild the search rows of user_ids from users, user_package and
+# rating_summary, in the caller's transaction. Users without packages drop out.
+def refresh_companion_search(cursor, user_ids):
+    ids = tuple(user_ids)
+    if not ids:
+        return
+    placeholders = ', '.join(['%s'] * len(ids))
+    cursor.execute(f"DELETE FROM companion_search WHERE user_id IN ({placeholders})", ids)
+    cursor.execute(f"""
+        INSERT INTO companion_search (user_id, gender, age, height, min_price, available_min_price, average_rate, total_count, created_at)
+        SELECT u.id, u.gender, u.age, u.height, MIN(p.price), MIN(CASE WHEN p.available THEN p.price END),
+               COALESCE(s.average_rate, 0), COALESCE(s.total_count, 0), u.created_at
+        FROM users u
+        JOIN user_package p ON p.user_id = u.id
+        LEFT JOIN rating_summary s ON s.gf_bf_id = u.id
+        WHERE u.id IN ({placeholders})
+        GROUP BY u.id, u.gender, u.age, u.height, u.created_at, s.average_rate, s.total_count
+    """, ids)
+
+# Copy rating_summary into the search rows of the companions rated by the
+# ratings matched by "where", after the summary changed
+def sync_search_ratings(cursor, where, params):
+    cursor.execute(f"""
+        UPDATE companion_search c JOIN rating_summary s ON s.gf_bf_id = c.user_id
+        SET c.average_rate = COALESCE(s.average_rate, 0), c.total_count = s.total_count
+        WHERE c.user_id IN (SELECT gf_bf_id FROM rating WHERE {where})
+    """, params)
+
+# Companions are users with at least one package. Price filters apply to the
+# cheapest package, or the cheapest available one with available=1;
+# available=0 finds companions with nothing available.
+# ?gender=&min_age=&max_age=&min_height=&max_height=&min_price=&max_price=
+#  &available=&min_rating=&sort=newest|rating|price|age|height&order=asc|desc&limit=&offset=
+@app.route('/api/companions/search', methods=['GET'])
+def search_companions():
+    args = request.args
+    limit, _ = get_page_args()
+    offset = max(0, min(args.get('offset', 0, type=int), app.config['SEARCH_MAX_OFFSET']))
+    sort_name = args.get('sort', 'newest')
+    if sort_name not in SEARCH_SORTS:
+        return jsonify({'error': 'Invalid sort !! '}), 400
+    order = 'ASC' if args.get('order', 'desc').lower() == 'asc' else 'DESC'
+
+    where = []
+    params = []
+    price = 'c.min_price'
+    if args.get('available') is not None:
+        if args.get('available') in ('1', 'true'):
+            price = 'c.available_min_price'
+            where.append("c.available_min_price IS NOT NULL")
+        else:
+            where.append("c.available_min_price IS NULL")
+    if args.get('gender', type=int) is not None:
+        where.append("c.gender = %s")
+        params.append(args.get('gender', type=int))
+    for column, name in ((price, 'price'), ('c.age', 'age'), ('c.height', 'height')):
+        if args.get(f"min_{name}", type=int) is not None:
+            where.append(f"{column} >= %s")
+            params.append(args.get(f"min_{name}", type=int))
+        if args.get(f"max_{name}", type=int) is not None:
+            where.append(f"{column} <= %s")
+            params.append(args.get(f"max_{name}", type=int))
+    if args.get('min_rating', type=float) is not None:
+        where.append("c.average_rate >= %s")
+        params.append(args.get('min_rating', type=float))
+    sort = SEARCH_SORTS[sort_name] or price
+
+    query = f"""
+        SELECT u.id, u.username, u.age, u.height, u.gender, u.profile_picture,
+               {price} AS min_price, c.average_rate, c.total_count
+        FROM companion_search c
+        JOIN users u ON u.id = c.user_id
+        {'WHERE ' + ' AND '.join(where) if where else ''}
+        ORDER BY {sort} {order}, c.user_id {order}
+        LIMIT %s OFFSET %s
+    """
+
+    cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
+    try:
+        cursor.execute(query, tuple(params) + (limit + 1, offset))
+        data = cursor.fetchall()
+        for row in data:
+            row['average_rate'] = float(row['average_rate'])
+        return page_response(data, limit, lambda row: offset + limit, cursor_arg='offset')
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cursor.close()
+
 # **** User Package ****
 #CREATE User Package
 @app.route('/api/user_package', methods=['POST'])
 @token_required
+@rate_limit('write')
 def create_user_package(id):
     data = request.get_json()
     data_id = generate_unique_number()
@@ -431,7 +1127,9 @@ def create_user_package(id):
             """,
             (data_id, user_id, data['price'], data['duration'], data['available'])
         )
+        refresh_companion_search(cursor, [user_id])
         mysql.connection.commit()
+        invalidate('user_package')
         return jsonify({'message': 'User package created successfully'}), 201
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -439,23 +1137,15 @@ def create_user_package(id):
         cursor.close()
 # READ ALL User Package
 @app.route('/api/user_package', methods=['GET'])
+@cached_response('user_package')
 def get_user_package():
     cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
     try:
-        cursor.execute("SELECT * FROM user_package")
+        cursor.execute(f"SELECT {PACKAGE_COLUMNS} FROM user_package")
         user_package = cursor.fetchall()
         if not user_package:
             return jsonify({'message': 'Package Not Found !! '}), 400
-        packages = []
-        for package in user_package:
-            packages.append({
-                'id': package['id'],
-                'user_id': package['user_id'],
-                'price': package['price'],
-                'duration': str(package['duration']),  # Ambil sebagai string waktu yang sudah disimpan
-                'available': package['available']
-            })
-        return jsonify(packages), 200
+        return json_response(user_package), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -463,22 +1153,16 @@ def get_user_package():
 
 # READ User Package BY Id
 @app.route('/api/user_package/<string:id>', methods=['GET'])
+@cached_response('user_package')
 def get_user_package_by_id(id):
     cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
     try:
-        cursor.execute("SELECT * FROM user_package WHERE id = %s", (id,))
+        cursor.execute(f"SELECT {PACKAGE_COLUMNS} FROM user_package WHERE id = %s", (id,))
         user_package = cursor.fetchone()
 
         if not user_package:
             return jsonify({'error': 'Package not found !! '}), 404
-        package = {
-            'id': user_package['id'],           # Indeks 0 adalah 'id'
-            'user_id': user_package['user_id'],      # Indeks 1 adalah 'user_id'
-            'price': user_package['price'],        # Indeks 2 adalah 'price'
-            'duration': str(user_package['duration']),# Indeks 3 adalah 'duration', ubah ke string
-            'available': user_package['available']     # Indeks 4 adalah 'available'
-        }
-        return jsonify(package), 200
+        return json_response(user_package), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -489,30 +1173,57 @@ def get_user_package_by_id(id):
 def get_user_package_by_user(username):
     cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
     try:
-        cursor.execute("SELECT * FROM users WHERE username = %s", (username, ))
+        cursor.execute("SELECT id FROM users WHERE username = %s", (username, ))
         data = cursor.fetchone()
         if not data:
             return jsonify({'error': 'User not found !! '}), 404
         
         user_id = data['id']
-        cursor.execute("SELECT * FROM user_package WHERE user_id = %s", (user_id, ))
+        cursor.execute(f"SELECT {PACKAGE_COLUMNS} FROM user_package WHERE user_id = %s", (user_id, ))
         user_package = cursor.fetchall()
         if not user_package:
             return jsonify({'message': 'Package not available for this user !! '}), 404
-        packages = []
-        for package in user_package:
-            packages.append({
-                'id': package['id'],
-                'user_id': package['user_id'],
-                'price': package['price'],
-                'duration': str(package['duration']),  # Ambil sebagai string waktu yang sudah disimpan
-                'available': package['available']
-            })
-        return jsonify(packages), 200
+        return json_response(user_package), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cursor.close()
+
+# READ User Package for many users in one query
+# body: {"usernames": [...]} or {"user_ids": [...]}
+@app.route('/api/user_package/batch', methods=['POST'])
+def get_user_package_batch():
+    data = request.get_json(silent=True) or {}
+    if data.get('usernames'):
+        keys, column = data['usernames'], 'username'
+    elif data.get('user_ids'):
+        keys, column = data['user_ids'], 'id'
+    else:
+        return jsonify({'error': 'usernames or user_ids is required !! '}), 400
+    if not isinstance(keys, list) or len(keys) > app.config['PAGE_LIMIT_MAX']:
+        return jsonify({'error': 'Invalid list of users !! '}), 400
+
+    cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
+    try:
+        placeholders = ', '.join(['%s'] * len(keys))
+        cursor.execute(
+            f"""
+            SELECT u.{column} AS owner, p.id, p.user_id, p.price, p.duration, p.available
+            FROM users u JOIN user_package p ON p.user_id = u.id
+            WHERE u.{column} IN ({placeholders})
+            ORDER BY p.user_id, p.id
+            """,
+            tuple(keys))
+        # Keyed by str, ids come back as int with ID_STORAGE 'bigint' and as sent by the client
+        result = {str(key): [] for key in keys}
+        for package in cursor.fetchall():
+            result.setdefault(str(package.pop('owner')), []).append(package)
+        return json_response(result), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
         cursor.close()
+
 # UPDATE User Package
 @app.route('/api/user_package/<string:package_id>', methods=['PUT'])
 @token_required
@@ -529,7 +1240,7 @@ def update_user_package(id, package_id):
     
     cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
     try:
-        cursor.execute("SELECT * FROM user_package WHERE id = %s AND user_id = %s", (package_id, id))
+        cursor.execute("SELECT id FROM user_package WHERE id = %s AND user_id = %s", (package_id, id))
         user = cursor.fetchone()
         if not user:
             return jsonify({'error': 'Package not found !! '}), 404
@@ -538,7 +1249,9 @@ def update_user_package(id, package_id):
             "UPDATE user_package SET price = %s, duration = %s, available = %s WHERE id = %s AND user_id = %s",
             (price, duration, available, package_id, id)
         )
+        refresh_companion_search(cursor, [id])
         mysql.connection.commit()
+        invalidate('user_package')
         return jsonify({'message': 'Data updated successfully !! '}), 200
     
     except Exception as e:
@@ -552,16 +1265,23 @@ def update_user_package(id, package_id):
 def delete_user_package(id, package_id):
     cursor = mysql.connection.cursor()
     try:
-        cursor.execute("DELETE FROM orders WHERE package_id = %s", (package_id, ))
-        mysql.connection.commit()
+        # Only orders on a package the caller owns
+        release_slots(cursor, "o.package_id = %s", (package_id, ))
+        cursor.execute(
+            "DELETE o FROM orders o JOIN user_package p ON p.id = o.package_id WHERE p.id = %s AND p.user_id = %s",
+            (package_id, id))
+        bump_counter(cursor, 'orders', -cursor.rowcount)
 
         cursor.execute("DELETE FROM user_package WHERE id = %s AND user_id = %s", (package_id, id))
-        mysql.connection.commit()
-
         if cursor.rowcount == 0:
+            mysql.connection.rollback()
             return jsonify({'error': 'Package not found !! '}), 404
+        refresh_companion_search(cursor, [id])
+        mysql.connection.commit()
+        invalidate('user_package', 'orders_total')
         return jsonify({'message': 'User package deleted successfully !! '}), 200
     except Exception as e:
+        mysql.connection.rollback()
         return jsonify({'error': str(e)}), 500
     finally:
         cursor.close()
@@ -573,25 +1293,72 @@ def admin_delete_user_package(id, package_id):
     if is_admin(id):
         cursor = mysql.connection.cursor()
         try:
+            cursor.execute("SELECT user_id FROM user_package WHERE id = %s", (package_id, ))
+            package = cursor.fetchone()
+            if not package:
+                return jsonify({'error': 'Package not found !! '}), 404
+
+            release_slots(cursor, "o.package_id = %s", (package_id, ))
             cursor.execute("DELETE FROM orders WHERE package_id = %s", (package_id, ))
-            mysql.connection.commit()
+            bump_counter(cursor, 'orders', -cursor.rowcount)
 
             cursor.execute("DELETE FROM user_package WHERE id = %s", (package_id, ))
+            refresh_companion_search(cursor, [package[0]])
             mysql.connection.commit()
-
-            if cursor.rowcount == 0:
-                return jsonify({'error': 'Package not found !! '}), 404
+            invalidate('user_package', 'orders_total')
             return jsonify({'message': 'User package deleted successfully !! '}), 200
         except Exception as e:
+            mysql.connection.rollback()
             return jsonify({'error': str(e)}), 500
         finally:
             cursor.close()
     else:
         return jsonify({'error': 'Bad request !! '}), 401
 # **** RATING ****
+RATE_HISTOGRAM = ', '.join(f"SUM(rate = {n}) AS rate_{n}" for n in range(1, 6))
+RATE_COLUMNS = ('total_rate', 'total_count') + tuple(f"rate_{n}" for n in range(1, 6))
+
+# Add the ratings matched by "where" into rating_summary (same transaction as the caller)
+def add_rating_aggregates(cursor, where, params):
+    updates = ', '.join(f"{c} = {c} + VALUES({c})" for c in RATE_COLUMNS)
+    cursor.execute(f"""
+        INSERT INTO rating_summary (gf_bf_id, {', '.join(RATE_COLUMNS)})
+        SELECT gf_bf_id, SUM(rate), COUNT(*), {RATE_HISTOGRAM}
+        FROM rating WHERE {where} GROUP BY gf_bf_id
+        ON DUPLICATE KEY UPDATE {updates}
+    """, params)
+    sync_search_ratings(cursor, where, params)
+
+# Subtract the ratings matched by "where", call it before they are changed or deleted
+def remove_rating_aggregates(cursor, where, params):
+    updates = ', '.join(f"s.{c} = s.{c} - d.{c}" for c in RATE_COLUMNS)
+    cursor.execute(f"""
+        UPDATE rating_summary s JOIN (
+            SELECT gf_bf_id, SUM(rate) AS total_rate, COUNT(*) AS total_count, {RATE_HISTOGRAM}
+            FROM rating WHERE {where} GROUP BY gf_bf_id
+        ) d ON d.gf_bf_id = s.gf_bf_id
+        SET {updates}
+    """, params)
+    sync_search_ratings(cursor, where, params)
+
+def rating_summary_json(data):
+    return {
+        'total_rate': int(data['total_rate']),
+        'total_count': int(data['total_count']),
+        'average rate': round(data['total_rate'] / data['total_count'], 2),
+        'histogram': {str(n): int(data[f"rate_{n}"]) for n in range(1, 6)}
+    }
+
+def valid_rate(rate):
+    try:
+        return 1 <= int(rate) <= 5
+    except (TypeError, ValueError):
+        return False
+
 #CREATE Rating
 @app.route('/api/rating', methods=['POST'])
 @token_required
+@rate_limit('write')
 def create_rating(id):
     rating_id = generate_unique_number()
     data = request.json
@@ -602,13 +1369,17 @@ def create_rating(id):
 
     if not gf_bf_id or not user_id or not rate or not review:
         return jsonify({'error': 'incomplete data !! '}), 401
+    if not valid_rate(rate):
+        return jsonify({'error': 'Rate must be between 1 and 5 !! '}), 400
     cursor = mysql.connection.cursor()
     try:
-        cursor.execute("SELECT * FROM rating WHERE gf_bf_id = %s AND user_id = %s", (gf_bf_id, user_id))
+        cursor.execute("SELECT id FROM rating WHERE gf_bf_id = %s AND user_id = %s", (gf_bf_id, user_id))
         user = cursor.fetchone()
         if not user:
             cursor.execute("INSERT INTO rating VALUES (%s, %s, %s, %s, %s)", (rating_id, gf_bf_id, user_id, rate, review))
+            add_rating_aggregates(cursor, "id = %s", (rating_id, ))
             mysql.connection.commit()
+            invalidate('rating')
             return jsonify({'message': 'Data uploaded successfully !! '}), 200
         else:
             return jsonify({'message': 'You have already rated this !! '}), 401
@@ -622,13 +1393,18 @@ def create_rating(id):
 #READ Rating
 @app.route('/api/rating', methods=['GET'])
 def read_rating():
+    limit, after = get_page_args()
+    query, params = keyset_query(f"SELECT {RATING_COLUMNS} FROM rating", after)
+    if wants_stream():
+        return stream_rows(query, params)
+
     cursor = mysql.connection.cursor()
     try:
-        cursor.execute("SELECT * FROM rating")
+        cursor.execute(query + " LIMIT %s", params + (limit + 1, ))
         data = cursor.fetchall()
-        if not data:
+        if not data and not after:
             return jsonify({'message': 'Data is not available !! '}), 404
-        return jsonify(data)
+        return page_response(data, limit, lambda row: row[0])
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -640,24 +1416,36 @@ def sum_rating(bf_gf_id):
     cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
 
     try:
-        cursor.execute("SELECT SUM(rate) AS total_rate, COUNT(rate) AS total_count FROM rating WHERE gf_bf_id = %s", (bf_gf_id, ))
+        cursor.execute(f"SELECT {', '.join(RATE_COLUMNS)} FROM rating_summary WHERE gf_bf_id = %s", (bf_gf_id, ))
         data = cursor.fetchone()
-        print(data['total_rate'])
 
         if not data or data['total_count'] == 0:
             return jsonify({'message': 'No rates found for this ID.'}), 404
-        
-        # Get Mean
-        total_rate = data['total_rate']
-        total_count = data['total_count']
 
-        average_rate = total_rate / total_count
+        return json_response(rating_summary_json(data)), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cursor.close()
 
-        return jsonify({
-            'total_rate': total_rate,
-            'total_count': total_count,
-            'average rate': round(average_rate, 2)
-        }), 200
+# SUM Rating for many ids in one call, body: {"ids": [...]}
+@app.route('/api/sum-rating/batch', methods=['POST'])
+def sum_rating_batch():
+    data = request.get_json(silent=True) or {}
+    ids = data.get('ids')
+    if not isinstance(ids, list) or not ids:
+        return jsonify({'error': 'ids must be a non empty list !! '}), 400
+    if len(ids) > app.config['PAGE_LIMIT_MAX']:
+        return jsonify({'error': 'Too many ids !! '}), 400
+
+    cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
+    try:
+        placeholders = ', '.join(['%s'] * len(ids))
+        cursor.execute(
+            f"SELECT gf_bf_id, {', '.join(RATE_COLUMNS)} FROM rating_summary WHERE gf_bf_id IN ({placeholders})",
+            tuple(ids))
+        result = {str(row['gf_bf_id']): rating_summary_json(row) for row in cursor.fetchall() if row['total_count'] > 0}
+        return json_response(result), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -665,15 +1453,16 @@ def sum_rating(bf_gf_id):
 
 #READ Rating by  Gf Bf Id
 @app.route('/api/rating/<string:id>', methods=['GET'])
+@cached_response('rating')
 def read_rating_by_id(id):
     cursor = mysql.connection.cursor()
     try:
-        cursor.execute("SELECT * FROM rating WHERE gf_bf_id = %s", (id, ))
+        cursor.execute(f"SELECT {RATING_COLUMNS} FROM rating WHERE gf_bf_id = %s", (id, ))
         data = cursor.fetchone()
 
         if not data:
             return jsonify({'message': 'Data is not available !! '}), 404
-        return jsonify(data)
+        return json_response(data)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -690,16 +1479,21 @@ def update_rating(id, rating_id):
 
     if not user_id or not rate or not review:
         return jsonify({'error': 'Incomplete data !! '}), 401
+    if not valid_rate(rate):
+        return jsonify({'error': 'Rate must be between 1 and 5 !! '}), 400
     
     cursor = mysql.connection.cursor()
     try:
-        cursor.execute("SELECT * FROM rating WHERE id = %s AND user_id = %s", (rating_id, id))
+        cursor.execute("SELECT id FROM rating WHERE id = %s AND user_id = %s", (rating_id, id))
         rating = cursor.fetchone()
         if not rating:
             return jsonify({'error': 'Data not found !! '}), 404
         
-        cursor.execute("UPDATE rating SET rate = %s, review = %s", (rate, review))
+        remove_rating_aggregates(cursor, "id = %s", (rating_id, ))
+        cursor.execute("UPDATE rating SET rate = %s, review = %s WHERE id = %s", (rate, review, rating_id))
+        add_rating_aggregates(cursor, "id = %s", (rating_id, ))
         mysql.connection.commit()
+        invalidate('rating')
 
         return jsonify({'message': 'Data updated successfully !! '}), 200
     except Exception as e:
@@ -714,14 +1508,16 @@ def delete_rating(id, rating_id):
     cursor = mysql.connection.cursor()
 
     try:
-        cursor.execute("SELECT * FROM rating WHERE id = %s AND user_id = %s", (rating_id, id))
+        cursor.execute("SELECT id FROM rating WHERE id = %s AND user_id = %s", (rating_id, id))
         data = cursor.fetchone()
 
         if not data:
             return jsonify({'error': 'Data not found !! '}), 400
         
+        remove_rating_aggregates(cursor, "id = %s", (rating_id, ))
         cursor.execute("DELETE FROM rating WHERE id = %s AND user_id = %s", (rating_id, id))
         mysql.connection.commit()
+        invalidate('rating')
 
         return jsonify({'message': 'Data deleted successfully !! '}), 200
     except Exception as e:
@@ -737,8 +1533,12 @@ def admin_delete_rating(id, rating_id):
         cursor = mysql.connection.cursor()
 
         try:
+            remove_rating_aggregates(cursor, "id = %s", (rating_id, ))
             cursor.execute("DELETE FROM rating WHERE id = %s", (rating_id, ))
+            if cursor.rowcount == 0:
+                return jsonify({'error': 'Data not found !! '}), 404
             mysql.connection.commit()
+            invalidate('rating')
 
             return jsonify({'message': 'Data deleted successfully !! '}), 200
         except Exception as e:
@@ -749,28 +1549,312 @@ def admin_delete_rating(id, rating_id):
         return jsonify({'error': 'Bad request !! '}), 401
 
 # **** ORDERS ****
-#CREATE Order
+# An order in any other status is open. An open order holds its package,
+# unless it was booked on an availability slot: those are bounded by the
+# slot's time and only hold the slot, so they never block the package.
+ORDER_CLOSED_STATUSES = ('completed', 'cancelled', 'expired')
+ORDER_STATUSES = ('pending', 'confirmed') + ORDER_CLOSED_STATUSES
+OPEN_ORDER_FILTER = f"status NOT IN ({', '.join(repr(s) for s in ORDER_CLOSED_STATUSES)})"
+PACKAGE_HOLD_FILTER = f"{OPEN_ORDER_FILTER} AND NOT EXISTS (SELECT 1 FROM availability_slots s WHERE s.order_id = orders.id)"
+
+def get_quantity(data):
+    try:
+        quantity = int(data.get('quantity', 1))
+    except (TypeError, ValueError):
+        return None
+    return quantity if quantity > 0 else None
+
+# Status changes a user may make, by their side of the order. Pending orders
+# nobody confirms expire after ORDER_PENDING_TTL, confirmed orders booked on a
+# slot complete when the slot ends; both run on the job queue.
+ORDER_TRANSITIONS = {
+    'customer': {
+        'pending': ('cancelled', ),
+        'confirmed': ('cancelled', ),
+    },
+    'companion': {
+        'pending': ('confirmed', 'cancelled'),
+        'confirmed': ('completed', 'cancelled'),
+    },
+}
+
+def allowed_statuses(current, customer=False, companion=False):
+    allowed = set()
+    if customer:
+        allowed.update(ORDER_TRANSITIONS['customer'].get(current, ()))
+    if companion:
+        allowed.update(ORDER_TRANSITIONS['companion'].get(current, ()))
+    return allowed
+
+# Jobs for new pending orders, in the caller's transaction. expire_in
+# overrides ORDER_PENDING_TTL (seconds).
+def orders_created(cursor, order_ids, expire_in=None):
+    if expire_in is None:
+        expire_in = app.config['ORDER_PENDING_TTL']
+    jobs.enqueue_many(cursor, 'order.expire', [({'order_id': order_id}, f"order.expire:{order_id}") for order_id in order_ids],
+                      delay=expire_in)
+    jobs.enqueue_many(cursor, 'order.notify', [({'order_id': order_id, 'status': 'pending'}, None) for order_id in order_ids])
+
+# Jobs after status changes, changes are (order_id, status). A confirmed order
+# booked on a slot completes at the end of the slot.
+def orders_status_changed(cursor, changes):
+    jobs.enqueue_many(cursor, 'order.notify', [({'order_id': order_id, 'status': status}, None) for order_id, status in changes])
+    confirmed = tuple(order_id for order_id, status in changes if status == 'confirmed')
+    if confirmed:
+        placeholders = ', '.join(['%s'] * len(confirmed))
+        cursor.execute(f"SELECT order_id, MAX(end_at) FROM availability_slots WHERE order_id IN ({placeholders}) GROUP BY order_id", confirmed)
+        for order_id, end_at in cursor.fetchall():
+            jobs.enqueue(cursor, 'order.complete', {'order_id': order_id}, run_at=end_at, dedupe_key=f"order.complete:{order_id}")
+
+@jobs.handler('order.expire')
+def expire_order(cursor, payload):
+    cursor.execute("UPDATE orders SET status = 'expired' WHERE id = %s AND status = 'pending'", (payload['order_id'], ))
+    if cursor.rowcount:
+        release_slots(cursor, "o.id = %s", (payload['order_id'], ))
+        orders_status_changed(cursor, [(payload['order_id'], 'expired')])
+
+@jobs.handler('order.complete')
+def complete_order(cursor, payload):
+    cursor.execute("UPDATE orders SET status = 'completed' WHERE id = %s AND status = 'confirmed'", (payload['order_id'], ))
+    if cursor.rowcount:
+        orders_status_changed(cursor, [(payload['order_id'], 'completed')])
+
+# Push the change to the customer and the companion over the chat stream
+@jobs.handler('order.notify')
+def notify_order(cursor, payload):
+    cursor.execute(
+        "SELECT o.user_id, p.user_id, o.package_id, o.total_price FROM orders o "
+        "JOIN user_package p ON p.id = o.package_id WHERE o.id = %s", (payload['order_id'], ))
+    order = cursor.fetchone()
+    if not order:
+        return
+    event = {
+        'event': 'order',
+        'order_id': payload['order_id'],
+        'package_id': order[2],
+        'status': payload['status'],
+        'total_price': order[3],
+    }
+    for user_id in {order[0], order[1]}:
+        broker.publish(f"user:{user_id}", event)
+
+#CREATE Order, price comes from the package (price per duration x quantity).
+# Orders start pending, only admins may create them in another status.
 @app.route('/api/order', methods=['POST'])
 @token_required
+@rate_limit('write')
 def create_order(id):
     order_id = generate_unique_number()
     data = request.json
-    package_id = data['package_id']
+    package_id = data.get('package_id')
     user_id = id
-    total_price = data['total_price']
-    status = data['status']
+    quantity = get_quantity(data)
+    status = data.get('status', 'pending')
 
-    if not package_id or not user_id or not total_price or not status:
+    if not package_id or not user_id or not quantity or not status:
         return jsonify({'error': 'Incomplete data !! '}), 401
+    if status not in ORDER_STATUSES:
+        return jsonify({'error': 'Invalid status !! '}), 400
+    if status != 'pending' and not is_admin(id):
+        return jsonify({'error': 'Only admins can create orders in another status than pending !! '}), 403
     
     cursor = mysql.connection.cursor()
 
     try:
-        cursor.execute("INSERT INTO orders VALUES (%s, %s, %s, %s, %s)", (order_id, package_id, user_id, total_price, status))
+        # Row lock serializes concurrent bookings of the same package
+        cursor.execute("SELECT price, duration, available FROM user_package WHERE id = %s FOR UPDATE", (package_id, ))
+        package = cursor.fetchone()
+        if not package:
+            mysql.connection.rollback()
+            return jsonify({'error': 'Package not found !! '}), 404
+        if not package[2]:
+            mysql.connection.rollback()
+            return jsonify({'error': 'Package is not available !! '}), 409
+
+        # Reads only the package's open orders through order_package_status
+        cursor.execute(f"SELECT 1 FROM orders WHERE package_id = %s AND {PACKAGE_HOLD_FILTER} LIMIT 1", (package_id, ))
+        if cursor.fetchone():
+            mysql.connection.rollback()
+            return jsonify({'error': 'Package is already booked !! '}), 409
+
+        total_price = package[0] * quantity
+        cursor.execute("INSERT INTO orders (id, package_id, user_id, total_price, status) VALUES (%s, %s, %s, %s, %s)", (order_id, package_id, user_id, total_price, status))
+        bump_counter(cursor, 'orders', 1)
+        if status == 'pending':
+            orders_created(cursor, [order_id])
+        else:
+            orders_status_changed(cursor, [(order_id, status)])
+        mysql.connection.commit()
+        invalidate('orders_total')
+
+        return jsonify({
+            'message': 'Data uploaded successfully !! ',
+            'id': order_id,
+            'total_price': total_price,
+            'duration': str(package[1]),
+            'quantity': quantity
+        }), 200
+    except Exception as e:
+        mysql.connection.rollback()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cursor.close()
+
+# Bulk body is a JSON array, or {"orders": [...]}
+def get_bulk_items():
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get('orders')
+    if not isinstance(data, list) or not data:
+        return None
+    return data
+
+#CREATE many Orders, items: {"package_id", "quantity", "status"}
+# Priced and checked like create_order. status defaults to pending, other
+# statuses are for admins importing orders; closed ones may be on any package.
+@app.route('/api/order/bulk', methods=['POST'])
+@token_required
+@rate_limit('write')
+def create_orders_bulk(id):
+    items = get_bulk_items()
+    if items is None:
+        return jsonify({'error': 'Body must be a non empty list of orders !! '}), 400
+    if len(items) > app.config['BULK_MAX_ITEMS']:
+        return jsonify({'error': 'Too many orders !! '}), 400
+
+    admin = is_admin(id)
+    results = [None] * len(items)
+    candidates = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not bulk_id(item.get('package_id')) or not item.setdefault('status', 'pending') or not get_quantity(item):
+            results[index] = {'index': index, 'error': 'Incomplete data !! '}
+        elif item['status'] not in ORDER_STATUSES:
+            results[index] = {'index': index, 'error': 'Invalid status !! '}
+        elif item['status'] != 'pending' and not admin:
+            results[index] = {'index': index, 'error': 'Only admins can create orders in another status than pending !! '}
+        else:
+            item['package_id'] = bulk_id(item['package_id'])
+            candidates.append(index)
+
+    cursor = mysql.connection.cursor()
+    try:
+        package_ids = tuple({items[i]['package_id'] for i in candidates})
+        packages = {}
+        booked = set()
+        if package_ids:
+            placeholders = ', '.join(['%s'] * len(package_ids))
+            cursor.execute(f"SELECT id, price, available FROM user_package WHERE id IN ({placeholders}) FOR UPDATE", package_ids)
+            packages = {str(row[0]): row for row in cursor.fetchall()}
+            cursor.execute(f"SELECT DISTINCT package_id FROM orders WHERE package_id IN ({placeholders}) AND {PACKAGE_HOLD_FILTER}", package_ids)
+            booked = {str(row[0]) for row in cursor.fetchall()}
+
+        rows = []
+        for index in candidates:
+            item = items[index]
+            package = packages.get(item['package_id'])
+            if not package:
+                results[index] = {'index': index, 'error': 'Package not found !! '}
+                continue
+            if item['status'] not in ORDER_CLOSED_STATUSES:
+                if not package[2]:
+                    results[index] = {'index': index, 'error': 'Package is not available !! '}
+                    continue
+                if item['package_id'] in booked:
+                    results[index] = {'index': index, 'error': 'Package is already booked !! '}
+                    continue
+                booked.add(item['package_id'])
+            order_id = generate_unique_number()
+            total_price = package[1] * get_quantity(item)
+            rows.append((order_id, item['package_id'], id, total_price, item['status']))
+            results[index] = {'index': index, 'id': order_id, 'total_price': total_price}
+
+        if rows:
+            cursor.executemany("INSERT INTO orders (id, package_id, user_id, total_price, status) VALUES (%s, %s, %s, %s, %s)", rows)
+            bump_counter(cursor, 'orders', len(rows))
+            orders_created(cursor, [row[0] for row in rows if row[4] == 'pending'])
+            orders_status_changed(cursor, [(row[0], row[4]) for row in rows if row[4] != 'pending'])
+        mysql.connection.commit()
+        invalidate('orders_total')
+        return jsonify({'created': len(rows), 'results': results}), 200
+    except Exception as e:
+        mysql.connection.rollback()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cursor.close()
+
+#UPDATE status of many Orders, items: {"id", "status"}
+# Admins may set any of ORDER_STATUSES on any order, other users only make the
+# customer's ORDER_TRANSITIONS on their own
+@app.route('/api/order/bulk', methods=['PUT'])
+@token_required
+@rate_limit('write')
+def update_orders_bulk(id):
+    items = get_bulk_items()
+    if items is None:
+        return jsonify({'error': 'Body must be a non empty list of orders !! '}), 400
+    if len(items) > app.config['BULK_MAX_ITEMS']:
+        return jsonify({'error': 'Too many orders !! '}), 400
+
+    results = [None] * len(items)
+    updates = {}
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not bulk_id(item.get('id')) or not isinstance(item.get('status'), str) or not item['status']:
+            results[index] = {'index': index, 'error': 'Incomplete data !! '}
+        elif item['status'] not in ORDER_STATUSES:
+            results[index] = {'index': index, 'error': 'Invalid status !! '}
+        else:
+            item['id'] = bulk_id(item['id'])
+            updates[item['id']] = item['status']
+
+    cursor = mysql.connection.cursor()
+    try:
+        admin = is_admin(id)
+        owner_filter, owner_params = "", ()
+        if not admin:
+            owner_filter, owner_params = " AND user_id = %s", (id, )
+
+        existing = set()
+        refused = {}
+        changes = []
+        if updates:
+            order_ids = tuple(updates)
+            placeholders = ', '.join(['%s'] * len(order_ids))
+            cursor.execute(f"SELECT id, status FROM orders WHERE id IN ({placeholders}){owner_filter} FOR UPDATE", order_ids + owner_params)
+            for order_id, current in cursor.fetchall():
+                order_id = str(order_id)
+                status = updates[order_id]
+                if status == current:
+                    existing.add(order_id)
+                elif admin or status in allowed_statuses(current, customer=True):
+                    existing.add(order_id)
+                    changes.append((order_id, status))
+                else:
+                    refused[order_id] = current
+
+        if existing:
+            order_ids = tuple(existing)
+            placeholders = ', '.join(['%s'] * len(order_ids))
+            cases = ' '.join(['WHEN %s THEN %s'] * len(order_ids))
+            case_params = tuple(value for order_id in order_ids for value in (order_id, updates[order_id]))
+            cursor.execute(
+                f"UPDATE orders SET status = CASE id {cases} END WHERE id IN ({placeholders})",
+                case_params + order_ids)
+            release_slots(cursor, f"o.id IN ({placeholders}) AND {SLOT_RELEASE_FILTER}", order_ids)
+            orders_status_changed(cursor, changes)
         mysql.connection.commit()
 
-        return jsonify({'message': 'Data uploaded successfully !! '}), 200
+        for index, item in enumerate(items):
+            if results[index] is None:
+                if item['id'] in existing:
+                    results[index] = {'index': index, 'id': item['id']}
+                elif item['id'] in refused:
+                    results[index] = {'index': index, 'id': item['id'],
+                                      'error': f"Can not change status from {refused[item['id']]} to {item['status']} !! "}
+                else:
+                    results[index] = {'index': index, 'id': item['id'], 'error': 'Data not found !! '}
+        return jsonify({'updated': len(existing), 'results': results}), 200
     except Exception as e:
+        mysql.connection.rollback()
         return jsonify({'error': str(e)}), 500
     finally:
         cursor.close()
@@ -778,15 +1862,20 @@ def create_order(id):
 # GET ALL Orders
 @app.route('/api/order', methods=['GET'])
 def get_order():
+    limit, after = get_page_args()
+    query, params = keyset_query(f"SELECT {ORDER_COLUMNS} FROM orders", after)
+    if wants_stream():
+        return stream_rows(query, params)
+
     cursor = mysql.connection.cursor()
     try:
-        cursor.execute("SELECT * FROM orders")
+        cursor.execute(query + " LIMIT %s", params + (limit + 1, ))
         data = cursor.fetchall()
 
-        if not data:
+        if not data and not after:
             return jsonify({'message': 'Data not found !! '}), 404
         
-        return jsonify(data)
+        return page_response(data, limit, lambda row: row[0])
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -797,12 +1886,12 @@ def get_order():
 def get_order_by_id(id):
     cursor = mysql.connection.cursor()
     try:
-        cursor.execute("SELECT * FROM orders WHERE id = %s", (id, ))
+        cursor.execute(f"SELECT {ORDER_COLUMNS} FROM orders WHERE id = %s", (id, ))
         data = cursor.fetchone()
 
         if not data:
             return jsonify({'message': 'Data not found !! '}), 404
-        return jsonify(data)
+        return json_response(data)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -813,12 +1902,12 @@ def get_order_by_id(id):
 def get_order_by_package(id):
     cursor = mysql.connection.cursor()
     try:
-        cursor.execute("SELECT * FROM orders WHERE package_id = %s", (id, ))
+        cursor.execute(f"SELECT {ORDER_COLUMNS} FROM orders WHERE package_id = %s", (id, ))
         data = cursor.fetchall()
 
         if not data:
             return jsonify({'message': 'Data not found !! '}), 404
-        return jsonify(data), 200
+        return json_response(data), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -830,42 +1919,97 @@ def get_order_by_package(id):
 def get_order_by_user(id):
     cursor = mysql.connection.cursor()
     try:
-        cursor.execute("SELECT * FROM orders WHERE user_id = %s", (id, ))
+        cursor.execute(f"SELECT {ORDER_COLUMNS} FROM orders WHERE user_id = %s", (id, ))
         data = cursor.fetchall()
 
         if not data:
             return jsonify({'message': 'Data not found !! '}), 404
-        return jsonify(data)
+        return json_response(data)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
         cursor.close()
 
-#UPDATE Order
+# Whether a price sent back by a client is the stored one: 100, 100.0 and
+# "100" all match an int column
+def same_price(value, stored):
+    if isinstance(value, bool):
+        return False
+    try:
+        return float(value) == float(stored)
+    except (TypeError, ValueError):
+        return False
+
+#UPDATE Order, body: {"status"}. Package and price are set by create_order
+# from the package row; they may be sent back unchanged but never changed here.
 @app.route('/api/order/<string:order_id>', methods=['PUT'])
 @token_required
 def update_order(id, order_id):
-    data = request.json
-    package_id = data['package_id']
-    user_id = id
-    total_price = data['total_price']
-    status = data['status']
+    data = request.get_json(silent=True) or {}
+    status = data.get('status')
 
-    if not package_id or not user_id or not total_price or not status:
+    if not status:
         return jsonify({'error': 'Incomplete data !! '}), 404
     
     cursor = mysql.connection.cursor()
     try:
-        cursor.execute("SELECT * FROM orders WHERE id = %s AND user_id = %s", (order_id, id))
+        cursor.execute("SELECT status, package_id, total_price FROM orders WHERE id = %s AND user_id = %s FOR UPDATE", (order_id, id))
         order = cursor.fetchone()
         if not order:
+            mysql.connection.rollback()
             return jsonify({'error': 'Data not found !! '}), 404
+        if ('package_id' in data and bulk_id(data['package_id']) != str(order[1])) or \
+           ('total_price' in data and not same_price(data['total_price'], order[2])):
+            mysql.connection.rollback()
+            return jsonify({'error': 'Package and price can not be changed, cancel and create a new order !! '}), 400
+        if status != order[0] and status not in allowed_statuses(order[0], customer=True):
+            mysql.connection.rollback()
+            return jsonify({'error': f"Can not change status from {order[0]} to {status} !! "}), 409
         
-        cursor.execute("UPDATE orders SET package_id = %s, user_id = %s, total_price = %s, status = %s WHERE id = %s AND user_id = %s", (package_id, user_id, total_price, status, order_id, id))
+        if status != order[0]:
+            cursor.execute("UPDATE orders SET status = %s WHERE id = %s AND user_id = %s", (status, order_id, id))
+            release_slots(cursor, f"o.id = %s AND {SLOT_RELEASE_FILTER}", (order_id, ))
+            orders_status_changed(cursor, [(order_id, status)])
         mysql.connection.commit()
         return jsonify({'message': 'Data updated successfully !! '}), 200
     except Exception as e:
-        return jsonify({'error', str(e)}), 500
+        mysql.connection.rollback()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cursor.close()
+
+#UPDATE Order status, body: {"status"}. The customer may cancel, the companion
+# who owns the package confirms, completes or cancels (ORDER_TRANSITIONS)
+@app.route('/api/order/<string:order_id>/status', methods=['PUT'])
+@token_required
+@rate_limit('write')
+def update_order_status(id, order_id):
+    data = request.get_json(silent=True) or {}
+    status = data.get('status')
+    if not status:
+        return jsonify({'error': 'Incomplete data !! '}), 400
+
+    cursor = mysql.connection.cursor()
+    try:
+        cursor.execute(
+            "SELECT o.status, o.user_id, p.user_id FROM orders o JOIN user_package p ON p.id = o.package_id "
+            "WHERE o.id = %s FOR UPDATE", (order_id, ))
+        order = cursor.fetchone()
+        if not order or id not in (order[1], order[2]):
+            mysql.connection.rollback()
+            return jsonify({'error': 'Data not found !! '}), 404
+        if status not in allowed_statuses(order[0], customer=id == order[1], companion=id == order[2]):
+            mysql.connection.rollback()
+            return jsonify({'error': f"Can not change status from {order[0]} to {status} !! "}), 409
+
+        cursor.execute("UPDATE orders SET status = %s WHERE id = %s", (status, order_id))
+        release_slots(cursor, f"o.id = %s AND {SLOT_RELEASE_FILTER}", (order_id, ))
+        orders_status_changed(cursor, [(order_id, status)])
+        mysql.connection.commit()
+        return jsonify({'message': 'Data updated successfully !! ', 'id': order_id, 'status': status}), 200
+    except Exception as e:
+        mysql.connection.rollback()
+        return jsonify({'error': str(e)}), 500
     finally:
         cursor.close()
 
@@ -877,14 +2021,17 @@ def delete_order(id, order_id):
     print(order_id)
     cursor = mysql.connection.cursor()
     try:
-        cursor.execute("SELECT * FROM orders WHERE id = %s AND user_id = %s", (order_id, id))
+        cursor.execute("SELECT id FROM orders WHERE id = %s AND user_id = %s", (order_id, id))
         data = cursor.fetchone()
 
         if not data:
             return jsonify({'message': 'Data not found !! '}), 404
         
+        release_slots(cursor, "o.id = %s", (order_id, ))
         cursor.execute("DELETE FROM orders WHERE id = %s AND user_id = %s", (order_id, id))
+        bump_counter(cursor, 'orders', -cursor.rowcount)
         mysql.connection.commit()
+        invalidate('orders_total')
 
         return jsonify({'message': 'Deleted data successfully !! '}), 200
     except Exception as e:
@@ -898,8 +2045,11 @@ def admin_delete_order(id, order_id):
     if is_admin(id):
         cursor = mysql.connection.cursor()
         try:
+            release_slots(cursor, "o.id = %s", (order_id, ))
             cursor.execute("DELETE FROM orders WHERE id = %s", (order_id, ))
+            bump_counter(cursor, 'orders', -cursor.rowcount)
             mysql.connection.commit()
+            invalidate('orders_total')
 
             return jsonify({'message': 'Deleted data successfully !! '}), 200
         except Exception as e:
@@ -907,19 +2057,401 @@ def admin_delete_order(id, order_id):
         finally:
             cursor.close()
 
+# **** Availability Slots ****
+# Companions publish the times they can be booked. Slots of one companion
+# never overlap and last at most SLOT_MAX_HOURS, so a lookup at time T only
+# reads start_at in (T - SLOT_MAX_HOURS, T] from slot_companion / slot_free
+# however long the booking history gets.
+SLOT_COLUMNS = "id, companion_id, start_at, end_at, order_id"
+
+# Orders in these statuses give their slot back
+SLOT_RELEASE_STATUSES = ('cancelled', 'expired')
+SLOT_RELEASE_FILTER = f"o.status IN ({', '.join(repr(s) for s in SLOT_RELEASE_STATUSES)})"
+
+def slot_max_length():
+    return datetime.timedelta(hours=app.config['SLOT_MAX_HOURS'])
+
+# ISO 8601 time from the client, as a naive local datetime like the rest of the DB
+def parse_time(value):
+    if not isinstance(value, str):
+        return None
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    try:
+        moment = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if moment.tzinfo is not None:
+        moment = moment.astimezone().replace(tzinfo=None)
+    return moment.replace(microsecond=0)
+
+# ?from=&to= window, from defaults to now and to to one day later
+def get_window():
+    start = parse_time(request.args['from']) if 'from' in request.args else datetime.datetime.now().replace(microsecond=0)
+    end = parse_time(request.args['to']) if 'to' in request.args else start and start + datetime.timedelta(days=1)
+    if not start or not end or end <= start or end - start > datetime.timedelta(days=app.config['SLOT_WINDOW_MAX_DAYS']):
+        return None
+    return start, end
+
+def slots_json(rows):
+    for row in rows:
+        row['start_at'] = row['start_at'].isoformat()
+        row['end_at'] = row['end_at'].isoformat()
+    return rows
+
+# Package durations needed to fill the slot, a package without duration counts once
+def slot_quantity(length, duration):
+    if not duration:
+        return 1
+    return max(1, math.ceil(length / duration))
+
+# Free the slots booked by the orders matched by "where" (orders as o), call it
+# before those orders are deleted
+def release_slots(cursor, where, params):
+    cursor.execute(f"UPDATE availability_slots s JOIN orders o ON o.id = s.order_id SET s.order_id = NULL WHERE {where}", params)
+
+#CREATE Slots for myself, body: {"start_at", "end_at"} or {"slots": [...]}
+@app.route('/api/slots', methods=['POST'])
+@token_required
+@rate_limit('write')
+def create_slots(id):
+    data = request.get_json(silent=True)
+    items = data.get('slots', [data]) if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'Incomplete data !! '}), 400
+    if len(items) > app.config['BULK_MAX_ITEMS']:
+        return jsonify({'error': 'Too many slots !! '}), 400
+
+    now = datetime.datetime.now()
+    slots = []
+    for item in items:
+        if not isinstance(item, dict):
+            return jsonify({'error': 'Incomplete data !! '}), 400
+        start_at, end_at = parse_time(item.get('start_at')), parse_time(item.get('end_at'))
+        if not start_at or not end_at:
+            return jsonify({'error': 'start_at and end_at must be ISO 8601 times !! '}), 400
+        if end_at <= start_at or end_at - start_at > slot_max_length():
+            return jsonify({'error': f"A slot must end after it starts and last at most {app.config['SLOT_MAX_HOURS']} hours !! "}), 400
+        if start_at < now:
+            return jsonify({'error': 'Slots must be in the future !! '}), 400
+        slots.append((start_at, end_at))
+    slots.sort()
+
+    cursor = mysql.connection.cursor()
+    try:
+        # User row lock serializes calendar changes of one companion
+        cursor.execute("SELECT id FROM users WHERE id = %s FOR UPDATE", (id, ))
+        if not cursor.fetchone():
+            mysql.connection.rollback()
+            return jsonify({'error': 'User not found !! '}), 404
+
+        cursor.execute(
+            "SELECT start_at, end_at FROM availability_slots WHERE companion_id = %s AND start_at > %s AND start_at < %s",
+            (id, slots[0][0] - slot_max_length(), slots[-1][1]))
+        # Existing slots never overlap each other, so any overlap involves a new one
+        intervals = sorted(slots + [tuple(row) for row in cursor.fetchall()])
+        if any(start_at < previous_end for (_, previous_end), (start_at, _) in zip(intervals, intervals[1:])):
+            mysql.connection.rollback()
+            return jsonify({'error': 'Slots overlap !! '}), 409
+
+        rows = [(generate_unique_number(), id, start_at, end_at) for start_at, end_at in slots]
+        cursor.executemany("INSERT INTO availability_slots (id, companion_id, start_at, end_at) VALUES (%s, %s, %s, %s)", rows)
+        mysql.connection.commit()
+        return jsonify({'message': 'Slots created successfully !! ', 'ids': [row[0] for row in rows]}), 201
+    except Exception as e:
+        mysql.connection.rollback()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cursor.close()
+
+#READ Slots of a companion overlapping ?from=&to=, ?free=1 for the unbooked ones
+@app.route('/api/companions/<string:companion_id>/slots', methods=['GET'])
+def get_companion_slots(companion_id):
+    window = get_window()
+    if window is None:
+        return jsonify({'error': f"Invalid window, at most {app.config['SLOT_WINDOW_MAX_DAYS']} days !! "}), 400
+    start, end = window
+
+    query = f"""SELECT {SLOT_COLUMNS} FROM availability_slots
+        WHERE companion_id = %s AND start_at > %s AND start_at < %s AND end_at > %s"""
+    if request.args.get('free') in ('1', 'true'):
+        query += " AND order_id IS NULL"
+    cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
+    try:
+        cursor.execute(query + " ORDER BY start_at", (companion_id, start - slot_max_length(), end, start))
+        return json_response(slots_json(cursor.fetchall())), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cursor.close()
+
+#READ Companions free at ?at=T, or for the whole of ?from=A&to=B
+@app.route('/api/companions/free', methods=['GET'])
+def get_free_companions():
+    limit, _ = get_page_args()
+    if 'at' in request.args:
+        start = end = parse_time(request.args['at'])
+    else:
+        start, end = parse_time(request.args.get('from')), parse_time(request.args.get('to'))
+    if not start or not end or end < start or end - start > slot_max_length():
+        return jsonify({'error': f"Give at, or from and to at most {app.config['SLOT_MAX_HOURS']} hours apart !! "}), 400
+
+    cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
+    try:
+        cursor.execute("""
+            SELECT s.id, s.companion_id, u.username, u.profile_picture, s.start_at, s.end_at
+            FROM availability_slots s JOIN users u ON u.id = s.companion_id
+            WHERE s.order_id IS NULL AND s.start_at > %s AND s.start_at <= %s AND s.end_at > %s AND s.end_at >= %s
+            ORDER BY s.start_at, s.id
+            LIMIT %s
+        """, (start - slot_max_length(), start, start, end, limit))
+        return json_response(slots_json(cursor.fetchall())), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cursor.close()
+
+#DELETE one of my Slots, booked slots stay until their order is cancelled
+@app.route('/api/slots/<string:slot_id>', methods=['DELETE'])
+@token_required
+def delete_slot(id, slot_id):
+    cursor = mysql.connection.cursor()
+    try:
+        cursor.execute("DELETE FROM availability_slots WHERE id = %s AND companion_id = %s AND order_id IS NULL", (slot_id, id))
+        if cursor.rowcount == 0:
+            cursor.execute("SELECT 1 FROM availability_slots WHERE id = %s AND companion_id = %s", (slot_id, id))
+            if cursor.fetchone():
+                return jsonify({'error': 'Slot is booked !! '}), 409
+            return jsonify({'error': 'Slot not found !! '}), 404
+        mysql.connection.commit()
+        return jsonify({'message': 'Slot deleted successfully !! '}), 200
+    except Exception as e:
+        mysql.connection.rollback()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cursor.close()
+
+#BOOK a Slot, body: {"package_id"} of the slot's companion. Priced like
+# create_order, the quantity is how many package durations fill the slot
+@app.route('/api/slots/<string:slot_id>/book', methods=['POST'])
+@token_required
+@rate_limit('write')
+def book_slot(id, slot_id):
+    data = request.get_json(silent=True) or {}
+    package_id = data.get('package_id')
+    if not package_id:
+        return jsonify({'error': 'Incomplete data !! '}), 400
+    order_id = generate_unique_number()
+
+    cursor = mysql.connection.cursor()
+    try:
+        # Row lock on the slot, a concurrent booking waits and then finds order_id set
+        cursor.execute("SELECT companion_id, start_at, end_at, order_id FROM availability_slots WHERE id = %s FOR UPDATE", (slot_id, ))
+        slot = cursor.fetchone()
+        if not slot:
+            mysql.connection.rollback()
+            return jsonify({'error': 'Slot not found !! '}), 404
+        if slot[3]:
+            mysql.connection.rollback()
+            return jsonify({'error': 'Slot is already booked !! '}), 409
+        if slot[1] <= datetime.datetime.now():
+            mysql.connection.rollback()
+            return jsonify({'error': 'Slot has already started !! '}), 409
+        if slot[0] == id:
+            mysql.connection.rollback()
+            return jsonify({'error': 'You can not book your own slot !! '}), 400
+
+        # Same package lock as create_order, a concurrent edit or delete of the
+        # package waits for the booking. Plain orders on it don't matter here.
+        cursor.execute("SELECT price, duration, available FROM user_package WHERE id = %s AND user_id = %s FOR UPDATE", (package_id, slot[0]))
+        package = cursor.fetchone()
+        if not package:
+            mysql.connection.rollback()
+            return jsonify({'error': 'Package not found !! '}), 404
+        if not package[2]:
+            mysql.connection.rollback()
+            return jsonify({'error': 'Package is not available !! '}), 409
+
+        quantity = slot_quantity(slot[2] - slot[1], package[1])
+        total_price = package[0] * quantity
+        cursor.execute("INSERT INTO orders (id, package_id, user_id, total_price, status) VALUES (%s, %s, %s, %s, %s)", (order_id, package_id, id, total_price, 'pending'))
+        cursor.execute("UPDATE availability_slots SET order_id = %s WHERE id = %s", (order_id, slot_id))
+        bump_counter(cursor, 'orders', 1)
+        # Unconfirmed by the time the slot starts, the booking lapses and frees the slot
+        orders_created(cursor, [order_id], expire_in=min(app.config['ORDER_PENDING_TTL'],
+                                                         (slot[1] - datetime.datetime.now()).total_seconds()))
+        mysql.connection.commit()
+        invalidate('orders_total')
+
+        return jsonify({
+            'message': 'Slot booked successfully !! ',
+            'id': order_id,
+            'slot_id': slot_id,
+            'total_price': total_price,
+            'duration': str(package[1]),
+            'quantity': quantity
+        }), 200
+    except Exception as e:
+        mysql.connection.rollback()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cursor.close()
+
 # **** Message ****
+MESSAGE_COLUMNS = "id, sender_id, recipient_id, message, is_read, created_at"
+
+# Thread cursor is "created_at|id" of a message
+def message_cursor(row):
+    return f"{row['created_at']:%Y-%m-%d %H:%M:%S.%f}|{row['id']}"
+
+# (created_at, id) of a message_cursor, ValueError when it isn't one
+def parse_message_cursor(value):
+    created_at, message_id = value.split('|', 1)
+    if not message_id:
+        raise ValueError(value)
+    return datetime.datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S.%f'), message_id
+
+# Both directions of a thread, each side read from (sender_id, recipient_id, created_at).
+# after/before are parsed cursors (parse_message_cursor)
+def fetch_thread(cursor, me, other, limit, after=None, before=None):
+    condition, params, order = "", (), "DESC"
+    if after:
+        created_at, message_id = after
+        condition = "AND (created_at > %s OR (created_at = %s AND id > %s))"
+        params, order = (created_at, created_at, message_id), "ASC"
+    elif before:
+        created_at, message_id = before
+        condition = "AND (created_at < %s OR (created_at = %s AND id < %s))"
+        params = (created_at, created_at, message_id)
+
+    branch = f"""(SELECT {MESSAGE_COLUMNS} FROM messages
+        WHERE sender_id = %s AND recipient_id = %s {condition}
+        ORDER BY created_at {order}, id {order} LIMIT %s)"""
+    cursor.execute(
+        f"{branch} UNION ALL {branch} ORDER BY created_at {order}, id {order} LIMIT %s",
+        (me, other) + params + (limit, other, me) + params + (limit, limit))
+    rows = list(cursor.fetchall())
+    # Always answer oldest first
+    if order == "DESC":
+        rows.reverse()
+    return rows
+
+#GET Thread, ?after=<cursor> for new messages, ?before=<cursor> for older history,
+# neither for the latest page
+@app.route('/api/message/thread/<string:other_id>', methods=['GET'])
+@token_required
+def get_thread(id, other_id):
+    limit, after = get_page_args()
+    before = request.args.get('before')
+    try:
+        after_key = parse_message_cursor(after) if after else None
+        before_key = parse_message_cursor(before) if before else None
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor !! '}), 400
+    cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
+    try:
+        data = fetch_thread(cursor, id, other_id, limit, after=after_key, before=before_key)
+        response = json_response(data)
+        if data:
+            response.headers['X-Next-Cursor'] = message_cursor(data[-1])
+            response.headers['X-Prev-Cursor'] = message_cursor(data[0])
+        elif after:
+            response.headers['X-Next-Cursor'] = after
+        return response, 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cursor.close()
+
+# Mark everything other_id sent me as read
+@app.route('/api/message/thread/<string:other_id>/read', methods=['PUT'])
+@token_required
+def read_thread(id, other_id):
+    cursor = mysql.connection.cursor()
+    try:
+        cursor.execute(
+            "UPDATE messages SET is_read = 1 WHERE sender_id = %s AND recipient_id = %s AND is_read = 0",
+            (other_id, id))
+        if cursor.rowcount:
+            cursor.execute(
+                "UPDATE unread_counter SET unread_count = GREATEST(unread_count - %s, 0) WHERE user_id = %s",
+                (cursor.rowcount, id))
+        mysql.connection.commit()
+        return jsonify({'message': 'Messages marked as read !! '}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cursor.close()
+
+#GET Unread count, served from unread_counter
+@app.route('/api/message/unread', methods=['GET'])
+@token_required
+def unread_count(id):
+    cursor = mysql.connection.cursor()
+    try:
+        cursor.execute("SELECT unread_count FROM unread_counter WHERE user_id = %s", (id, ))
+        data = cursor.fetchone()
+        return jsonify({'unread': data[0] if data else 0}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cursor.close()
+
+# Server-Sent Events stream of messages sent to me. The SSE id is the thread
+# cursor, so after a reconnect the client catches up with /api/message/thread/<id>?after=
+# My orders changing status come as "order" events, without an id
+@app.route('/api/message/stream', methods=['GET'])
+@token_required
+def message_stream(id):
+    if not stream_limiter.acquire():
+        response = jsonify({'error': 'Too many open streams, poll /api/message/thread/<id> for now !! '})
+        response.headers['Retry-After'] = '30'
+        return response, 503
+    try:
+        subscription = broker.subscribe(f"user:{id}")
+    except Exception:
+        stream_limiter.release()
+        app.logger.exception('Could not subscribe to the chat stream')
+        response = jsonify({'error': 'Chat stream is unavailable, poll /api/message/thread/<id> for now !! '})
+        response.headers['Retry-After'] = '30'
+        return response, 503
+    heartbeat = app.config['SSE_HEARTBEAT']
+
+    def generate():
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                message = subscription.get(timeout=heartbeat)
+                if message is None:
+                    # Keeps proxies from closing the connection and notices gone clients
+                    yield ': keep-alive\n\n'
+                elif message.get('event') == 'order':
+                    yield f"event: order\ndata: {json.dumps(message)}\n\n"
+                else:
+                    yield f"event: message\nid: {message['cursor']}\ndata: {json.dumps(message)}\n\n"
+        finally:
+            subscription.close()
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    # Runs when the server closes the response, even if the body never started
+    response.call_on_close(subscription.close)
+    response.call_on_close(stream_limiter.release)
+    return response
+
 #GET Message
 @app.route('/api/message/<string:recipient_id>', methods=['GET'])
 @token_required
 def get_mesagge(id, recipient_id):
     cursor = mysql.connection.cursor()
     try:
-        cursor.execute("SELECT * FROM messages WHERE sender_id = %s AND recipient_id = %s", (id, recipient_id))
+        cursor.execute(f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE sender_id = %s AND recipient_id = %s", (id, recipient_id))
         data = cursor.fetchall()
 
         if not data:
             return jsonify({'message': 'There is no chat yet !! '}), 404
-        return jsonify(data)
+        return json_response(data)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -928,22 +2460,40 @@ def get_mesagge(id, recipient_id):
 # CREATE Message
 @app.route('/api/message', methods=['POST'])
 @token_required
+@rate_limit('message')
 def create_message(id):
     message_id = generate_unique_number() #Generate random number for id
     data = request.json
     sender_id = id
     recipient_id = data['recipient_id']
     message = data['message']
-    is_read = 1
+    is_read = 0
+    created_at = datetime.datetime.now()
 
-    if not sender_id or not recipient_id or not message or not is_read:
+    if not sender_id or not recipient_id or not message:
         return jsonify({'error': 'Incomplete data !! '}), 401
     
     cursor = mysql.connection.cursor()
     try:
-        cursor.execute("INSERT INTO messages VALUES (%s, %s, %s, %s, %s)", (message_id, sender_id, recipient_id, message, is_read))
+        cursor.execute(
+            "INSERT INTO messages (id, sender_id, recipient_id, message, is_read, created_at) VALUES (%s, %s, %s, %s, %s, %s)",
+            (message_id, sender_id, recipient_id, message, is_read, created_at))
+        cursor.execute(
+            "INSERT INTO unread_counter (user_id, unread_count) VALUES (%s, 1) ON DUPLICATE KEY UPDATE unread_count = unread_count + 1",
+            (recipient_id, ))
         mysql.connection.commit()
 
+        payload = {
+            'id': message_id,
+            'sender_id': sender_id,
+            'recipient_id': recipient_id,
+            'message': message,
+            'is_read': is_read,
+            'created_at': f"{created_at:%Y-%m-%d %H:%M:%S.%f}",
+        }
+        payload['cursor'] = message_cursor({'id': message_id, 'created_at': created_at})
+        broker.publish(f"user:{recipient_id}", payload)
+
         return jsonify({'message': 'Your message has been sent !! '}), 200
     except Exception as e:
         return jsonify({'error': str(e)})
@@ -955,12 +2505,16 @@ def create_message(id):
 def delete_message(id, message_id):
     cursor = mysql.connection.cursor()
     try:
-        cursor.execute("SELECT * FROM messages WHERE id = %s AND sender_id = %s", (message_id, id))
+        cursor.execute("SELECT recipient_id, is_read FROM messages WHERE id = %s AND sender_id = %s", (message_id, id))
         data = cursor.fetchone()
 
         if not data:
             return jsonify({'error': 'Data not found !! '}), 404
         cursor.execute("DELETE FROM messages WHERE id = %s", (message_id, ))
+        if not data[1]:
+            cursor.execute(
+                "UPDATE unread_counter SET unread_count = GREATEST(unread_count - 1, 0) WHERE user_id = %s",
+                (data[0], ))
         mysql.connection.commit()
 
         return jsonify({'message': 'Message deleted successfully !! '}), 200
@@ -970,6 +2524,34 @@ def delete_message(id, message_id):
         cursor.close()
 
 
+# **** Startup / Shutdown ****
+_started = False
+
+# Warm up pools and start background jobs, once per process
+def create_app():
+    global _started
+    if not _started:
+        _started = True
+        try:
+            mysql.get_pool().warm()
+        except Exception:
+            app.logger.exception('Could not open database connections at startup')
+        hasher.warm()
+        start_counter_reconciler()
+        if app.config['JOB_WORKERS']:
+            jobs.start()
+    return app
+
+# Close everything the process holds, after in-flight requests have finished
+def shutdown():
+    jobs.stop()
+    thumbnails.stop()
+    hasher.shutdown()
+    broker.close()
+    mysql.close()
+
+
 if __name__ == '__main__':
-    app.run(port=3002, debug=True)
+    create_app()
+    app.run(port=3002, debug=app.config['DEBUG'])
     # app.run(debug=True)
\ No newline at end of file
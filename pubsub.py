@@ -0,0 +1,136 @@
+import json
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    def __init__(self, broker, channel, maxsize):
+        self.broker = broker
+        self.channel = channel
+        self.queue = queue.Queue(maxsize=maxsize)
+
+    # Next message, or None when nothing arrived within timeout
+    def get(self, timeout=None):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+# In-process fan out, enough for a single worker process
+class MemoryBroker:
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._channels = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel):
+        subscription = Subscription(self, channel, self.queue_size)
+        with self._lock:
+            self._channels.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._channels.get(subscription.channel)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._channels[subscription.channel]
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscribers = list(self._channels.get(channel, ()))
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(message)
+            except queue.Full:
+                # Slow consumer, it can catch up from the thread endpoint
+                pass
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(s) for s in self._channels.values())
+
+    def close(self):
+        pass
+
+
+# Publishes through Redis so subscribers in every worker process see every
+# message. One listener thread per process feeds a local MemoryBroker and
+# reconnects when Redis goes away; messages published meanwhile are missed,
+# clients catch up from the thread endpoint.
+class RedisBroker:
+    def __init__(self, url, prefix='rentagf:', queue_size=100, retry_max=30):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.retry_max = retry_max
+        self._local = MemoryBroker(queue_size)
+        self._listener = None
+        self._pubsub = None
+        self._closed = threading.Event()
+        self._lock = threading.Lock()
+
+    def _listen(self):
+        delay = 1
+        while not self._closed.is_set():
+            try:
+                self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                self._pubsub.psubscribe(self.prefix + '*')
+                delay = 1
+                for item in self._pubsub.listen():
+                    if item['type'] != 'pmessage':
+                        continue
+                    channel = item['channel'].decode()[len(self.prefix):]
+                    self._local.publish(channel, json.loads(item['data']))
+            except Exception:
+                if self._closed.is_set():
+                    return
+                logger.exception('Redis pubsub listener lost its connection, retrying in %ds', delay)
+                try:
+                    self._pubsub.close()
+                except Exception:
+                    pass
+                self._closed.wait(delay)
+                delay = min(delay * 2, self.retry_max)
+
+    def _start(self):
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, name='pubsub-redis', daemon=True)
+                self._listener.start()
+
+    def subscribe(self, channel):
+        self._start()
+        return self._local.subscribe(channel)
+
+    def unsubscribe(self, subscription):
+        self._local.unsubscribe(subscription)
+
+    def publish(self, channel, message):
+        self._redis.publish(self.prefix + channel, json.dumps(message, default=str))
+
+    def subscriber_count(self):
+        return self._local.subscriber_count()
+
+    def close(self):
+        self._closed.set()
+        if self._pubsub is not None:
+            self._pubsub.close()
+
+
+def create_broker(app):
+    backend = app.config.get('PUBSUB_BACKEND', 'memory')
+    queue_size = app.config.get('PUBSUB_QUEUE_SIZE', 100)
+    if backend == 'redis':
+        return RedisBroker(app.config['PUBSUB_REDIS_URL'], queue_size=queue_size)
+    if backend == 'memory':
+        return MemoryBroker(queue_size)
+    raise ValueError(f"Unknown PUBSUB_BACKEND {backend!r}")
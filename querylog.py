@@ -0,0 +1,99 @@
+import logging
+import threading
+import MySQLdb.cursors
+
+from db import normalize_statement
+
+logger = logging.getLogger(__name__)
+
+
+# Types of the parameters, never their values (passwords go through here)
+def param_shape(args, many=False):
+    if args is None:
+        return '()'
+    if many:
+        rows = list(args)
+        first = param_shape(rows[0]) if rows else '()'
+        return f"{len(rows)} x {first}"
+    if isinstance(args, dict):
+        return '{' + ', '.join(f"{k}: {type(v).__name__}" for k, v in args.items()) + '}'
+    if isinstance(args, (list, tuple)):
+        return '(' + ', '.join(type(v).__name__ for v in args) + ')'
+    return type(args).__name__
+
+
+# Query hook (see MySQLPool.query_hooks): aggregates every statement by its
+# normalized text, logs the ones slower than threshold_ms and, when enabled,
+# captures EXPLAIN the first time a statement is slow
+class QueryLog:
+    def __init__(self, threshold_ms=200, explain=False, max_statements=500):
+        self.threshold = threshold_ms / 1000
+        self.explain = explain
+        self.max_statements = max_statements
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, connection, cursor, query, args, seconds):
+        statement = normalize_statement(query)
+        slow = seconds >= self.threshold
+        with self._lock:
+            item = self._stats.get(statement)
+            if item is None:
+                if len(self._stats) >= self.max_statements:
+                    statement = '<other>'
+                item = self._stats.setdefault(statement, {
+                    'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0,
+                    'slow_count': 0, 'explain': None, 'full_scan': False,
+                })
+            item['count'] += 1
+            item['total_seconds'] += seconds
+            item['max_seconds'] = max(item['max_seconds'], seconds)
+            if slow:
+                item['slow_count'] += 1
+            need_explain = slow and self.explain and item['explain'] is None
+        if not slow:
+            return
+
+        many = isinstance(args, list) and args and isinstance(args[0], (list, tuple, dict))
+        logger.warning('Slow query %.1f ms %s params=%s', seconds * 1000, statement, param_shape(args, many))
+        if need_explain and not many:
+            self._explain(connection, cursor, statement, query, args)
+
+    def _explain(self, connection, cursor, statement, query, args):
+        # An unbuffered cursor still owns the connection until it is read to the end
+        if isinstance(cursor, MySQLdb.cursors.CursorUseResultMixIn):
+            return
+        text = query.decode() if isinstance(query, bytes) else query
+        if not text.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', '(')):
+            return
+        explain_cursor = connection.cursor(MySQLdb.cursors.DictCursor)
+        try:
+            explain_cursor.execute('EXPLAIN ' + text, args)
+            plan = list(explain_cursor.fetchall())
+        except MySQLdb.Error:
+            logger.exception('EXPLAIN failed for %s', statement)
+            return
+        finally:
+            explain_cursor.close()
+
+        full_scans = [row.get('table') for row in plan if row.get('type') == 'ALL']
+        with self._lock:
+            item = self._stats.get(statement)
+            if item is not None:
+                item['explain'] = plan
+                item['full_scan'] = bool(full_scans)
+        if full_scans:
+            logger.warning('Full table scan on %s for %s', ', '.join(map(str, full_scans)), statement)
+
+    # Statements ordered by total time spent
+    def report(self, limit=50):
+        with self._lock:
+            items = [dict(item, statement=statement) for statement, item in self._stats.items()]
+        for item in items:
+            item['avg_seconds'] = item['total_seconds'] / item['count']
+        items.sort(key=lambda item: item['total_seconds'], reverse=True)
+        return items[:limit]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
@@ -0,0 +1,132 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__('Rate limit exceeded')
+        self.retry_after = retry_after
+
+
+# Token buckets: each key holds up to burst tokens and gets rate tokens per
+# second back. take() answers (allowed, seconds until enough tokens).
+class MemoryRateLimitBackend:
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost=1):
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                tokens = burst
+                # Least recently used keys go first, they come back with a full bucket
+                while len(self._buckets) >= self.maxsize:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            if tokens >= cost:
+                self._buckets[key] = [tokens - cost, now]
+                return True, 0.0
+            self._buckets[key] = [tokens, now]
+            return False, (cost - tokens) / rate
+
+    def stats(self):
+        with self._lock:
+            return {'keys': len(self._buckets)}
+
+
+# Same bucket kept in Redis and updated by a script, so every worker process
+# draws from one bucket per key
+_TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1])
+if tokens == nil then
+    tokens = burst
+else
+    tokens = math.min(burst, tokens + (now - tonumber(bucket[2])) * rate)
+end
+local allowed = 0
+local retry = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(retry)}
+"""
+
+
+class RedisRateLimitBackend:
+    def __init__(self, url, prefix='rentagf:ratelimit:'):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self._take = self._redis.register_script(_TAKE_SCRIPT)
+        self.prefix = prefix
+
+    def take(self, key, rate, burst, cost=1):
+        allowed, retry = self._take(keys=[self.prefix + key], args=[rate, burst, cost])
+        return bool(allowed), float(retry)
+
+    def stats(self):
+        return {}
+
+
+def create_rate_limiter(app):
+    backend = app.config.get('RATE_LIMIT_BACKEND', 'memory')
+    if backend == 'redis':
+        return RedisRateLimitBackend(app.config['RATE_LIMIT_REDIS_URL'])
+    if backend == 'memory':
+        return MemoryRateLimitBackend(app.config.get('RATE_LIMIT_MAX_KEYS', 100000))
+    raise ValueError(f"Unknown RATE_LIMIT_BACKEND {backend!r}")
+
+
+# Caps the requests one process works on at the same time. A request that
+# can't get a slot within wait seconds is turned away instead of queueing
+# on the connection pool.
+class ConcurrencyLimiter:
+    def __init__(self, limit, wait=0.0):
+        self.limit = limit
+        self.wait = wait
+        self._slots = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._rejected = 0
+
+    def acquire(self):
+        if self.wait:
+            acquired = self._slots.acquire(timeout=self.wait)
+        else:
+            acquired = self._slots.acquire(blocking=False)
+        if not acquired:
+            with self._lock:
+                self._rejected += 1
+            return False
+        with self._lock:
+            self._in_flight += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'limit': self.limit,
+                'in_flight': self._in_flight,
+                'rejected_total': self._rejected,
+            }
@@ -0,0 +1,40 @@
+import datetime
+import decimal
+import json
+
+from flask import Response
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Types MySQLdb hands back that JSON has no name for. Dates keep the format
+# jsonify used, TIME columns (timedelta) read like the stored value "2:00:00".
+def default(value):
+    if isinstance(value, datetime.timedelta):
+        return str(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return http_date(value)
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+# Rows (tuples or dicts from the cursor) to JSON bytes in one pass, with
+# orjson when it's installed. Non str dict keys (bigint ids) become strings
+# like json.dumps does.
+if orjson is not None:
+    def dumps(data):
+        return orjson.dumps(data, default=default, option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS)
+else:
+    def dumps(data):
+        return json.dumps(data, default=default, separators=(',', ':')).encode()
+
+
+def json_response(data):
+    return Response(dumps(data), mimetype='application/json')
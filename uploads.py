@@ -0,0 +1,118 @@
+import hashlib
+import logging
+import os
+import queue
+import tempfile
+import threading
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+CHUNK_SIZE = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+# Stream an upload to disk while hashing it, then move it to a path named
+# after its content. Identical images end up stored once.
+# Returns (path relative to root, True if the file is new)
+def store_upload(stream, root, extension):
+    os.makedirs(root, exist_ok=True)
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=root, prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+
+        name = digest.hexdigest()
+        relative = os.path.join(name[:2], f"{name}.{extension}")
+        path = os.path.join(root, relative)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            return relative, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        return relative, True
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# Remove a file store_upload just created, when what it was for failed.
+# Only for created=True: an existing file is someone else's picture too.
+def discard_upload(root, relative):
+    try:
+        os.remove(os.path.join(root, relative))
+    except FileNotFoundError:
+        pass
+
+
+def thumbnail_path(relative, size):
+    return os.path.join('thumbs', str(size), relative)
+
+
+# Resizes new uploads in a background thread. Needs Pillow, without it the
+# originals are served as they are.
+class ThumbnailWorker:
+    def __init__(self, root, sizes=(64, 256)):
+        self.root = root
+        self.sizes = sizes
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        # Started lazily, and again in a forked worker
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name='thumbnails', daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+
+    # False without Pillow, there are no thumbnails to point clients at
+    @property
+    def enabled(self):
+        return Image is not None
+
+    def submit(self, relative):
+        if not self.enabled:
+            return
+        self._start()
+        self._queue.put(relative)
+
+    def _run(self):
+        while True:
+            relative = self._queue.get()
+            if relative is None:
+                return
+            try:
+                self.make_thumbnails(relative)
+            except Exception:
+                logger.exception('Thumbnail failed for %s', relative)
+
+    def make_thumbnails(self, relative):
+        if not self.enabled:
+            return
+        with Image.open(os.path.join(self.root, relative)) as image:
+            for size in self.sizes:
+                target = os.path.join(self.root, thumbnail_path(relative, size))
+                if os.path.exists(target):
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                thumb = image.copy()
+                thumb.thumbnail((size, size))
+                thumb.save(target)
+
+    def stop(self):
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=10)
@@ -0,0 +1,31 @@
+import argparse
+import os
+import signal
+import threading
+
+# Job runner without the web server: python worker.py --threads 4
+# Pair it with JOB_WORKERS=0 on the app processes to keep jobs off them.
+# Order notifications reach browsers only with PUBSUB_BACKEND = 'redis'.
+os.environ.setdefault('APP_CONFIG', 'config.ProductionConfig')
+
+from main import app, jobs, mysql, shutdown
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run background jobs')
+    parser.add_argument('--threads', type=int, default=max(1, app.config['JOB_WORKERS']))
+    args = parser.parse_args()
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+
+    mysql.get_pool().warm()
+    jobs.start(args.threads)
+    app.logger.info('Running jobs with %d threads', args.threads)
+    stop.wait()
+    shutdown()
+
+
+if __name__ == '__main__':
+    main()
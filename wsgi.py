@@ -0,0 +1,8 @@
+import os
+
+# Production entry point: gunicorn -c gunicorn.conf.py wsgi:app
+os.environ.setdefault('APP_CONFIG', 'config.ProductionConfig')
+
+from main import create_app
+
+app = create_app()